@@ -0,0 +1,511 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Library interface for running HeaderFix from other programs.
+
+For example,
+
+    for result in header.api.process('/path/to/repo', ['src']):
+        if result.changed:
+            sys.stdout.write(result.diff())
+
+Nothing is printed, and nothing is asked.  A Session keeps parsed
+configuration files, the global Git configuration, and cached fixes
+between calls, so programs which check many paths should keep using
+the same session, or use the module-level process() function, which
+uses a shared session.
+"""
+import itertools
+import multiprocessing.pool
+import os
+import subprocess
+from . import archive
+from . import copyright
+from . import explain
+from . import filetype
+from . import git
+from . import history
+from . import memo
+from . import pattern
+from . import rule
+from . import scan
+from . import shard
+from . import sourcefile
+from . import throttle
+from . import util
+
+class Options(object):
+    """Options for processing files.
+
+    copyright_author: the author for new copyright notices, or None to
+        use the Git user.name setting.
+    copyright_years: the years for new copyright notices, as a
+        year.YearRanges, or None for the current year.
+    ignore: a list of extra patterns for files to ignore.
+    whitespace: true to fix whitespace and expand tabs.
+    cached: true to process the contents of the index instead of the
+        work tree.
+    shard: an (index, count) pair to only process one shard of the
+        files, or None.
+    shard_by: how files are assigned to shards, "hash" or "size".
+    cache_size: the number of fixes to remember for files with
+        identical contents, or 0 to run the filters on every file.
+    scan_threads: the number of threads listing directories in the
+        work tree, or 1 to list them one at a time.
+    file_rate: the most files to read per second, or None.
+    io_rate: the most bytes to read and write per second, or None.
+    """
+    __slots__ = ['copyright_author', 'copyright_years', 'ignore',
+                 'whitespace', 'cached', 'shard', 'shard_by', 'cache_size',
+                 'scan_threads', 'file_rate', 'io_rate']
+
+    def __init__(self, copyright_author=None, copyright_years=None,
+                 ignore=(), whitespace=False, cached=False,
+                 shard=None, shard_by='hash', cache_size=256,
+                 scan_threads=1, file_rate=None, io_rate=None):
+        self.copyright_author = copyright_author
+        self.copyright_years = copyright_years
+        self.ignore = list(ignore)
+        self.whitespace = whitespace
+        self.cached = cached
+        self.shard = shard
+        self.shard_by = shard_by
+        self.cache_size = cache_size
+        self.scan_threads = scan_threads
+        self.file_rate = file_rate
+        self.io_rate = io_rate
+
+class Result(object):
+    """The result of processing one file.
+
+    path: the absolute path to the file.
+    relpath: the path relative to the current directory.
+    name: the path relative to the repository root.
+    filetype: the file type.
+    original: the original contents.
+    contents: the fixed contents.
+    changed: true if the fixed contents differ from the original.
+    """
+    __slots__ = ['source', 'name', 'throttle']
+
+    def __init__(self, source, name, throttle=None):
+        self.source = source
+        self.name = name
+        self.throttle = throttle
+
+    @property
+    def path(self):
+        return self.source.path
+
+    @property
+    def relpath(self):
+        return self.source.relpath
+
+    @property
+    def filetype(self):
+        return self.source.filetype
+
+    @property
+    def original(self):
+        return self.source.orig
+
+    @property
+    def contents(self):
+        return self.source.contents()
+
+    @property
+    def changed(self):
+        return self.source.changed()
+
+    def diff(self):
+        """Get a unified diff of the changes, or None."""
+        return self.source.diff()
+
+    def long_lines(self):
+        """Iterate over (lineno, width) for lines which are too long."""
+        return self.source.long_lines()
+
+    def save(self):
+        """Write the fixed contents.
+
+        In cached mode, the contents are staged in the index, and this
+        must be called before the iteration over results finishes.
+        """
+        if self.throttle is not None:
+            self.throttle.write(len(self.contents))
+        self.source.save()
+
+def relpath_parts(path, base):
+    """Split a path into components relative to a base directory.
+
+    Raises ValueError if the path is not inside the base directory.
+    """
+    parts = []
+    curpath = path
+    while curpath != base:
+        lastpath = curpath
+        curpath, fname = os.path.split(curpath)
+        if lastpath == curpath:
+            raise ValueError(
+                'path not contained in repository: {}'.format(path))
+        parts.append(fname)
+    parts.reverse()
+    return parts
+
+def top_paths(paths):
+    """Remove paths which are inside other paths in a list.
+
+    The paths are lists of path components.  The order of the
+    remaining paths is preserved.
+    """
+    paths = [tuple(path) for path in paths]
+    pathset = set(paths)
+    result = []
+    for path in paths:
+        if any(path[:n] in pathset for n in range(1, len(path))):
+            continue
+        if path in result:
+            continue
+        result.append(path)
+    return [list(path) for path in result]
+
+def exclude_patterns(options):
+    """Get the patterns for files which the options exclude."""
+    return pattern.PatternSet(
+        pattern.PatternSet.parse(['.*'], 'hidden files').patterns +
+        pattern.PatternSet.parse(options.ignore, '--ignore').patterns)
+
+class Repository(object):
+    """Information about a repository which is kept between calls."""
+    __slots__ = ['root', 'filetype_cache', 'classifier', 'authorships']
+
+    def __init__(self, root, filetype_cache):
+        self.root = root
+        self.filetype_cache = filetype_cache
+        self.classifier = filetype.Classifier(filetype_cache)
+        self.authorships = {}
+
+    def authorship(self, author, years, interactive):
+        key = author, years, interactive
+        try:
+            return self.authorships[key]
+        except KeyError:
+            pass
+        authorship = copyright.AutoAuthorship(
+            self.root, author, years, interactive)
+        self.authorships[key] = authorship
+        return authorship
+
+class Session(object):
+    """State kept between calls to process files.
+
+    If interactive is true, the user may be asked for the copyright
+    author, otherwise the author comes from the options or the Git
+    configuration.  The number of paths which process() has scanned,
+    including files which are not source files, is kept in scanned,
+    for reporting progress.
+    """
+    __slots__ = ['interactive', 'repositories', 'directories', 'config',
+                 'global_rules', 'fix_cache', 'throttle', 'scanned']
+
+    def __init__(self, interactive=False):
+        self.interactive = interactive
+        self.repositories = {}
+        self.directories = {}
+        self.config = scan.ConfigCache()
+        self.global_rules = None
+        self.fix_cache = None
+        self.throttle = None
+        self.scanned = 0
+
+    def repository(self, path):
+        """Get the repository containing a directory.
+
+        Raises ValueError if the directory is not in a repository.
+        """
+        path = os.path.abspath(path)
+        try:
+            return self.directories[path]
+        except KeyError:
+            pass
+        try:
+            out = subprocess.check_output(
+                ['git', 'rev-parse', '--show-toplevel',
+                 '--git-path', 'headerfix/filetypes'],
+                cwd=path)
+        except subprocess.CalledProcessError:
+            raise ValueError('not in a Git repository: {}'.format(path))
+        root, cache_path = util.decode(out).splitlines()
+        try:
+            repo = self.repositories[root]
+        except KeyError:
+            repo = Repository(root, os.path.join(path, cache_path))
+            self.repositories[root] = repo
+        self.directories[path] = repo
+        return repo
+
+    def base_rules(self, repo, options):
+        """Get the rules which apply to the whole repository."""
+        if self.global_rules is None:
+            self.global_rules = rule.Rules.read_global_gitignore() or False
+        authorship = repo.authorship(
+            options.copyright_author, options.copyright_years,
+            self.interactive)
+        rules = rule.Rules({'_authorship': authorship}, [])
+        if self.global_rules:
+            rules = rules.union(self.global_rules)
+        return rules
+
+    def invalidate(self, path=None):
+        """Forget cached configuration for a file, or for all files.
+
+        Configuration files are read again anyway when they change on
+        disk.  Forgetting everything also forgets the Git
+        configuration and the copyright author.
+        """
+        if path is not None:
+            self.config.invalidate(os.path.abspath(path))
+            return
+        self.close()
+        self.config.invalidate()
+        self.global_rules = None
+        self.repositories.clear()
+        self.directories.clear()
+
+    def process(self, root, paths=None, options=None):
+        """Process files in a repository.
+
+        The root is any directory in the repository.  The paths are
+        relative to the root, and default to the entire repository.
+        Yields a Result for each source file.
+        """
+        if options is None:
+            options = Options()
+        fix_cache = self._fix_cache(options)
+        repo = self.repository(root)
+        if not paths:
+            paths = ['.']
+        paths = [relpath_parts(os.path.abspath(os.path.join(root, path)),
+                               repo.root)
+                 for path in paths]
+        if all(paths):
+            paths = top_paths(paths)
+        else:
+            paths = None
+        if options.cached and paths is not None:
+            includes = pattern.PatternSet(
+                (True, pattern.LiteralPattern(True, path, 'command line'))
+                for path in paths)
+        else:
+            includes = None
+        if options.shard is not None:
+            index, count = options.shard
+            includes = shard.intersect(
+                includes,
+                shard.SHARD_METHODS[options.shard_by](
+                    repo.root, index, count))
+        excludes = exclude_patterns(options)
+        rules = self.base_rules(repo, options)
+        if options.cached:
+            sources = self._scan_cached(repo, rules, includes, excludes)
+        else:
+            sources = self._scan_worktree(
+                repo, rules, paths, includes, excludes,
+                options.scan_threads)
+        limiter = self._throttle(options)
+        for src in sources:
+            limiter.read(len(src.orig))
+            fix_cache.fix(src, options.whitespace)
+            yield Result(src, os.path.relpath(src.path, repo.root), limiter)
+
+    def process_file(self, path, contents=None, options=None):
+        """Process one file in the work tree.
+
+        If contents is not None, it is used instead of the contents of
+        the file on disk, which need not exist, and the diff shows the
+        changes to the given contents.  Returns a Result, or None if the
+        file is not a source file or is ignored.
+        """
+        if options is None:
+            options = Options()
+        fix_cache = self._fix_cache(options)
+        path = os.path.abspath(path)
+        repo = self.repository(os.path.dirname(path))
+        parts = relpath_parts(path, repo.root)
+        if not parts:
+            return None
+        excludes = exclude_patterns(options)
+        env = scan.path_env(self.base_rules(repo, options), repo.root,
+                            parts, excludes, self.config)
+        if env is None:
+            return None
+        if contents is None:
+            ftype, contents = repo.classifier.classify(path)
+            cls = sourcefile.SourceFile
+        else:
+            ftype = filetype.get_filetype(path)
+            if ftype.name == 'unknown' and not os.path.splitext(path)[1]:
+                ftype = filetype.sniff_filetype(
+                    contents[:filetype.SNIFF_SIZE])
+            cls = sourcefile.BufferFile
+        if ftype.name == 'unknown':
+            return None
+        src = cls(path, os.path.relpath(path), env, ftype, contents)
+        limiter = self._throttle(options)
+        limiter.read(len(src.orig))
+        fix_cache.fix(src, options.whitespace)
+        return Result(src, '/'.join(parts), limiter)
+
+    def process_archive(self, path, output=None, options=None):
+        """Process the files in a tar archive.
+
+        Yields a Result for each source file.  If output is not None,
+        the archive is copied to output, with the changes to files
+        which were saved.  The global gitignore file is not used.
+        """
+        if options is None:
+            options = Options()
+        fix_cache = self._fix_cache(options)
+        limiter = self._throttle(options)
+        for src in archive.scan_archive(self._stream_rules(options), path,
+                                        exclude_patterns(options), output):
+            limiter.read(len(src.orig))
+            fix_cache.fix(src, options.whitespace)
+            yield Result(src, src.name, limiter)
+
+    def rewrite_history(self, infp, outfp, options=None):
+        """Rewrite history from a git fast-export stream.
+
+        Yields a Result for each blob which is a source file, once for
+        each distinct environment it appears in.  A stream for git
+        fast-import is written to outfp, with the changes to blobs
+        which were saved.
+        """
+        if options is None:
+            options = Options()
+        fix_cache = self._fix_cache(options)
+        limiter = self._throttle(options)
+        for src in history.rewrite(self._stream_rules(options),
+                                   exclude_patterns(options), infp, outfp):
+            limiter.read(len(src.orig))
+            fix_cache.fix(src, options.whitespace)
+            yield Result(src, src.name, limiter)
+
+    def _stream_rules(self, options):
+        """Get the base rules for files which are not in a work tree."""
+        authorship = copyright.AutoAuthorship(
+            None, options.copyright_author, options.copyright_years,
+            self.interactive)
+        return rule.Rules({'_authorship': authorship}, [])
+
+    def explain(self, path, options=None):
+        """Explain how the environment for a file is computed.
+
+        Returns a list of lines of text.
+        """
+        if options is None:
+            options = Options()
+        path = os.path.abspath(path)
+        repo = self.repository(os.path.dirname(path))
+        parts = relpath_parts(path, repo.root)
+        if not parts:
+            raise ValueError('cannot explain the repository root')
+        return explain.explain(self.base_rules(repo, options), repo.root,
+                               parts, exclude_patterns(options),
+                               self.config)
+
+    def close(self):
+        """Save cached information about files."""
+        for repo in self.repositories.values():
+            try:
+                repo.classifier.save()
+            except (IOError, OSError):
+                pass
+
+    def _fix_cache(self, options):
+        if (self.fix_cache is None or
+            self.fix_cache.size != options.cache_size):
+            self.fix_cache = memo.FixCache(options.cache_size)
+        return self.fix_cache
+
+    def _throttle(self, options):
+        if (self.throttle is None or
+            self.throttle.file_rate != options.file_rate or
+            self.throttle.io_rate != options.io_rate):
+            self.throttle = throttle.Throttle(options.file_rate,
+                                              options.io_rate)
+        return self.throttle
+
+    def _scan_worktree(self, repo, rules, paths, includes, excludes,
+                       threads):
+        root = repo.root
+        if threads > 1:
+            pool = multiprocessing.pool.ThreadPool(threads)
+        else:
+            pool = None
+        if paths is None:
+            files = scan.scan_dir(rules, root, includes, excludes,
+                                  self.config, pool)
+        else:
+            files = itertools.chain.from_iterable(
+                scan.scan_path(rules, root, path, includes, excludes,
+                               self.config, pool)
+                for path in paths)
+        try:
+            for path, env in files:
+                self.scanned += 1
+                ftype, data = repo.classifier.classify(path)
+                if ftype.name == 'unknown':
+                    continue
+                yield sourcefile.SourceFile(
+                    path, os.path.relpath(path), env, ftype, data)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            try:
+                repo.classifier.save()
+            except (IOError, OSError):
+                pass
+
+    def _scan_cached(self, repo, rules, includes, excludes):
+        root = repo.root
+        catfile = git.CatFile(root)
+        writer = git.IndexWriter(root)
+        try:
+            entries = git.ls_files(root)
+            read = lambda entry: catfile.read(entry[1])
+            for entry, env in scan.scan_index(rules, entries, includes,
+                                              excludes, read):
+                mode, sha, name = entry
+                self.scanned += 1
+                ftype = filetype.get_filetype(name)
+                data = None
+                if ftype.name == 'unknown' and not os.path.splitext(name)[1]:
+                    data = read(entry)
+                    ftype = filetype.sniff_filetype(
+                        data[:filetype.SNIFF_SIZE])
+                if ftype.name == 'unknown':
+                    continue
+                if data is None:
+                    data = read(entry)
+                path = os.path.join(root, name)
+                yield sourcefile.IndexFile(
+                    path, os.path.relpath(path), env, ftype, data,
+                    name, mode, writer)
+        finally:
+            catfile.close()
+            writer.close()
+
+_SESSION = None
+
+def process(root, paths=None, options=None):
+    """Process files in a repository using a shared session.
+
+    See Session.process().
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = Session()
+    return _SESSION.process(root, paths, options)
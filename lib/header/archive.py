@@ -0,0 +1,180 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Fixing source files in tar archives.
+
+Archives are read and written as streams, in one pass, without
+extracting them.  Only one member is in memory at a time.  The
+.gitignore and .header members apply to the members which come after
+them in the archive.
+"""
+import copy
+import io
+import os
+import tarfile
+from . import filetype
+from . import rule
+from . import scan
+from . import sourcefile
+from . import util
+
+CONFIG_READERS = {
+    '.gitignore': rule.Rules.read_gitignore,
+    '.header': rule.Rules.read,
+}
+
+def member_parts(name):
+    """Split the name of an archive member into path components."""
+    return [part for part in name.split('/') if part and part != '.']
+
+COMPRESSION = [
+    (('.tar.gz', '.tgz'), 'gz'),
+    (('.tar.bz2', '.tbz2', '.tbz'), 'bz2'),
+]
+
+def _write_mode(path):
+    """Get the mode for writing an archive, from its name."""
+    name = path.lower()
+    for exts, compression in COMPRESSION:
+        if name.endswith(exts):
+            return 'w|' + compression
+    return 'w|'
+
+class ArchiveRules(object):
+    """The rules for the members of an archive.
+
+    Configuration members are added as they are read, and the rules
+    for each directory are cached until a configuration member in the
+    directory or one of its parents changes them.
+    """
+    __slots__ = ['rules', 'excludes', 'configs', 'dirs']
+
+    def __init__(self, rules, excludes):
+        self.rules = rules
+        self.excludes = excludes
+        self.configs = {}
+        self.dirs = {}
+
+    def add_config(self, parts, data):
+        """Add a configuration member."""
+        dirparts = tuple(parts[:-1])
+        fp = util.text_file(data, '/'.join(parts))
+        self.configs.setdefault(dirparts, {})[parts[-1]] = \
+            CONFIG_READERS[parts[-1]](fp)
+        n = len(dirparts)
+        for key in list(self.dirs):
+            if key[:n] == dirparts:
+                del self.dirs[key]
+
+    def dir_rules(self, dirparts):
+        """Get (rules, excludes) for a directory, or None if skipped."""
+        try:
+            return self.dirs[dirparts]
+        except KeyError:
+            pass
+        if dirparts:
+            value = self.dir_rules(dirparts[:-1])
+            if value is not None:
+                rules, excludes = value
+                value = scan._dir_rules(rules, dirparts[-1], None, excludes)
+            if value is not None:
+                rules, _, excludes = value
+        else:
+            rules = self.rules
+            excludes = self.excludes
+            value = True
+        if value is not None:
+            configs = self.configs.get(dirparts, {})
+            for name in ('.gitignore', '.header'):
+                if name in configs:
+                    rules = rules.union(configs[name])
+            value = rules, excludes
+        self.dirs[dirparts] = value
+        return value
+
+    def file_env(self, parts):
+        """Get the environment for a member, or None if it is skipped."""
+        value = self.dir_rules(tuple(parts[:-1]))
+        if value is None:
+            return None
+        rules, excludes = value
+        return scan._file_env(rules, parts[-1], None, excludes)
+
+def _source(arules, tar, info):
+    """Get the source file for a member, or None.
+
+    Returns (source, data), where data is the contents of the member
+    if it was read.
+    """
+    parts = member_parts(info.name)
+    if not info.isfile() or not parts:
+        return None, None
+    if parts[-1] in CONFIG_READERS:
+        data = tar.extractfile(info).read()
+        arules.add_config(parts, data)
+        return None, data
+    env = arules.file_env(parts)
+    if env is None:
+        return None, None
+    ftype = filetype.get_filetype(parts[-1])
+    data = None
+    if ftype.name == 'unknown' and not os.path.splitext(parts[-1])[1]:
+        data = tar.extractfile(info).read()
+        ftype = filetype.sniff_filetype(data[:filetype.SNIFF_SIZE])
+    if ftype.name == 'unknown':
+        return None, data
+    if data is None:
+        data = tar.extractfile(info).read()
+    return sourcefile.ArchiveFile(env, ftype, data, info.name), data
+
+def _write(out, tar, info, data):
+    if out is None:
+        return
+    if data is not None:
+        info = copy.copy(info)
+        info.size = len(data)
+        out.addfile(info, io.BytesIO(data))
+    elif info.isfile():
+        out.addfile(info, tar.extractfile(info))
+    else:
+        out.addfile(info)
+
+def scan_archive(rules, path, excludes, output=None):
+    """Scan the members of a tar archive.
+
+    Yields an ArchiveFile for each source file.  If output is not
+    None, every member is copied to an archive with that name, and
+    source files which were saved are copied with their changes.  If
+    the caller stops early, the rest of the members are copied
+    unchanged.
+    """
+    arules = ArchiveRules(rules, excludes)
+    tar = tarfile.open(path, 'r|*')
+    try:
+        out = None
+        if output is not None:
+            out = tarfile.open(output, _write_mode(output))
+        try:
+            members = iter(tar)
+            for info in members:
+                src, data = _source(arules, tar, info)
+                if src is not None:
+                    try:
+                        yield src
+                    except GeneratorExit:
+                        if src.saved:
+                            data = src.contents()
+                        _write(out, tar, info, data)
+                        for info in members:
+                            _write(out, tar, info, None)
+                        raise
+                    if src.saved:
+                        data = src.contents()
+                _write(out, tar, info, data)
+        finally:
+            if out is not None:
+                out.close()
+    finally:
+        tar.close()
@@ -0,0 +1,493 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Microbenchmarks of the functions which take most of a run's time.
+
+The inputs are generated from a fixed seed, so every run times the
+same work.  Results are saved as JSON, and a baseline is kept for each
+machine and Python version, since times from different machines
+cannot be compared.  To save a baseline, and later check for
+regressions against it:
+
+    python -m header.bench run --save
+    python -m header.bench compare
+
+The compare command runs the benchmarks again, or reads results saved
+with run --output, and exits with status 1 if any benchmark is slower
+than the baseline by more than the threshold.  Each benchmark is
+timed several times, and the best time is compared, since it is the
+least affected by other work on the machine.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import timeit
+from . import comment
+from . import copyright
+from . import filetype
+from . import pattern
+from . import rule
+from . import sourcefile
+from . import util
+from . import year
+
+SEED = 2013
+
+DEFAULT_BASELINE_DIR = os.path.join('~', '.headerfix', 'bench')
+
+SYLLABLES = ['ar', 'buf', 'cfg', 'dec', 'enc', 'fmt', 'io', 'lex', 'map',
+             'net', 'obj', 'parse', 'queue', 'rt', 'str', 'tab', 'util',
+             'vec', 'win', 'x']
+EXTS = ['.c', '.h', '.cpp', '.hpp', '.py', '.sh', '.o', '.a', '.txt',
+        '.in', '.xml', '']
+AUTHORS = ['Dietrich Epp', 'Example Corp', 'The Project Authors',
+           'Jane Q. Public', 'Foo Bar Industries, Inc']
+
+BENCHMARKS = []
+
+def benchmark(name):
+    """Register a benchmark.
+
+    The decorated function generates the input and returns the
+    function to time.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+def _stem(rand):
+    return '_'.join(rand.choice(SYLLABLES)
+                    for _ in range(rand.randint(1, 3)))
+
+def _names(rand, count):
+    """Generate file names like those in a source tree."""
+    return [_stem(rand) + rand.choice(EXTS) for _ in range(count)]
+
+def _patterns(rand, count):
+    """Generate gitignore patterns."""
+    patterns = []
+    for _ in range(count):
+        kind = rand.randint(0, 5)
+        if kind == 0:
+            pat = '*' + rand.choice(EXTS[:-1])
+        elif kind == 1:
+            pat = _stem(rand) + rand.choice(EXTS)
+        elif kind == 2:
+            pat = _stem(rand) + '/'
+        elif kind == 3:
+            pat = '/{}/*{}'.format(_stem(rand), rand.choice(EXTS[:-1]))
+        elif kind == 4:
+            pat = '{}/{}*'.format(_stem(rand), rand.choice(SYLLABLES))
+        else:
+            pat = '!' + _stem(rand) + rand.choice(EXTS)
+        patterns.append(pat)
+    return patterns
+
+def _header_file(rand, groups):
+    """Generate the text of a .header file."""
+    lines = [
+        'guards = true\n',
+        'guardname = BENCH\n',
+        'width = 79\n',
+        'copyright_notice = <<EOF\n',
+        'All rights reserved.\n',
+        'EOF\n',
+    ]
+    for _ in range(groups):
+        lines.append('{\n')
+        for pat in _patterns(rand, rand.randint(1, 3)):
+            sign = '-' if pat.startswith('!') else '+'
+            lines.append('    {} {}\n'.format(sign, pat.lstrip('!')))
+        setting = rand.randint(0, 4)
+        if setting == 0:
+            lines.append('    ignore\n')
+        elif setting == 1:
+            lines.append('    width = {}\n'.format(rand.choice([72, 79, 100])))
+        elif setting == 2:
+            lines.append('    tabsize = {}\n'.format(rand.choice([2, 4, 8])))
+        elif setting == 3:
+            lines.append('    {\n        + *.h\n        extern_c = true\n'
+                         '    }\n')
+        else:
+            lines.append('    guards = false\n')
+        lines.append('}\n')
+    return util.encode(''.join(lines))
+
+def _read_rules(data):
+    return rule.Rules.read(util.text_file(data, '.header'))
+
+def _years(rand):
+    """Generate a list of years as it appears in a copyright notice."""
+    parts = []
+    start = rand.randint(1990, 2005)
+    for _ in range(rand.randint(1, 4)):
+        end = start + rand.randint(0, 3)
+        if end > start:
+            parts.append('{}-{}'.format(start, end))
+        else:
+            parts.append(str(start))
+        start = end + rand.randint(2, 4)
+    return ', '.join(parts)
+
+def _notice(rand):
+    """Generate the lines of a copyright notice."""
+    lines = []
+    for _ in range(rand.randint(1, 3)):
+        lines.append('Copyright {} {}.\n'.format(
+            _years(rand), rand.choice(AUTHORS)))
+    lines.append('\n')
+    lines.append('All rights reserved.\n')
+    return lines
+
+def _source_file(rand, nlines):
+    """Generate the contents of a C file with whitespace to fix."""
+    lines = [b'/* Copyright 2001-2003 Example Corp.\n',
+             b'   All rights reserved. */\n']
+    for n in range(nlines):
+        kind = rand.randint(0, 9)
+        if kind == 0:
+            lines.append(b'\n')
+        elif kind == 1:
+            lines.append(b'\tint x%d = f(y);   \n' % n)
+        elif kind == 2:
+            lines.append(b'    /* ' + b'long comment ' * rand.randint(4, 9) +
+                         b'*/\n')
+        else:
+            lines.append(b'    x = %s(x, %d);\n' % (
+                util.encode(_stem(rand)), n))
+    lines.extend([b'\n'] * 3)
+    return b''.join(lines)
+
+@benchmark('pattern.match_file')
+def bench_match_file(rand):
+    patternset = pattern.PatternSet.parse(_patterns(rand, 100))
+    names = _names(rand, 1000)
+    def run():
+        for name in names:
+            patternset.match_file(name)
+    return run
+
+@benchmark('pattern.match_dir')
+def bench_match_dir(rand):
+    patternset = pattern.PatternSet.parse(_patterns(rand, 100))
+    names = [_stem(rand) for _ in range(300)]
+    def run():
+        for name in names:
+            patternset.match_dir(name)
+    return run
+
+@benchmark('rule.file_env')
+def bench_file_env(rand):
+    rules = _read_rules(_header_file(rand, 100))
+    names = _names(rand, 1000)
+    def run():
+        for name in names:
+            rules.file_env(name)
+    return run
+
+@benchmark('rule.dir_rules')
+def bench_dir_rules(rand):
+    rules = _read_rules(_header_file(rand, 100))
+    names = [_stem(rand) for _ in range(300)]
+    def run():
+        for name in names:
+            rules.dir_rules(name)
+    return run
+
+@benchmark('rule.Lexer')
+def bench_lexer(rand):
+    data = _header_file(rand, 2000)
+    def run():
+        for _ in rule.Lexer(util.text_file(data, '.header')):
+            pass
+    return run
+
+@benchmark('comment.extract_lead_comments')
+def bench_extract_lead_comments(rand):
+    ftype = filetype.get_filetype('bench.c')
+    files = []
+    for _ in range(200):
+        lines = [b'/* ' + util.encode(line) for line in _notice(rand)]
+        lines[-1] = lines[-1][:-1] + b' */\n'
+        lines.extend([b'\n', b'// Generated file.\n', b'\n'])
+        lines.extend(b'int x%d;\n' % n for n in range(50))
+        files.append(lines)
+    def run():
+        for lines in files:
+            comment.extract_lead_comments(lines, ftype)
+    return run
+
+@benchmark('copyright.Authorship.parse')
+def bench_authorship_parse(rand):
+    notices = [_notice(rand) for _ in range(200)]
+    def run():
+        for lines in notices:
+            copyright.Authorship().parse(lines)
+    return run
+
+@benchmark('copyright.Authorship.dump')
+def bench_authorship_dump(rand):
+    authorship = copyright.Authorship()
+    for n in range(50):
+        authorship.add_author('{} {}'.format(rand.choice(AUTHORS), n),
+                              year.parse_years(_years(rand)))
+    def run():
+        for _ in range(20):
+            authorship.dump()
+    return run
+
+@benchmark('year.parse_years')
+def bench_parse_years(rand):
+    strings = [_years(rand) for _ in range(1000)]
+    def run():
+        for string in strings:
+            year.parse_years(string)
+    return run
+
+@benchmark('year.format_years')
+def bench_format_years(rand):
+    yearsets = [year.parse_years(_years(rand)) for _ in range(1000)]
+    def run():
+        for yearset in yearsets:
+            year.format_years(yearset)
+    return run
+
+def _source_bench(rand, method):
+    ftype = filetype.get_filetype('bench.c')
+    env = dict(rule.DEFAULT_ENV, width=79)
+    data = _source_file(rand, 5000)
+    def run():
+        src = sourcefile.ArchiveFile(env, ftype, data, 'bench.c')
+        return method(src)
+    return run
+
+@benchmark('SourceFile.fix_whitespace')
+def bench_fix_whitespace(rand):
+    return _source_bench(rand, sourcefile.SourceFile.fix_whitespace)
+
+@benchmark('SourceFile.expand_tabs')
+def bench_expand_tabs(rand):
+    return _source_bench(rand, sourcefile.SourceFile.expand_tabs)
+
+@benchmark('SourceFile.long_lines')
+def bench_long_lines(rand):
+    return _source_bench(rand, lambda src: list(src.long_lines()))
+
+def calibrate(timer, min_time):
+    """Get the number of calls which take at least min_time seconds."""
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            return number
+        if elapsed > 0:
+            number = max(number * 2, int(number * min_time / elapsed) + 1)
+        else:
+            number *= 10
+
+def machine_info():
+    """Get a description of the machine and the Python version."""
+    return {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'python': '{} {}'.format(platform.python_implementation(),
+                                 platform.python_version()),
+    }
+
+def baseline_path(directory, info):
+    """Get the path to the baseline for a machine."""
+    version = '.'.join(info['python'].split()[-1].split('.')[:2])
+    name = '{}-{}-{}{}'.format(info['node'], info['machine'],
+                               info['python'].split()[0].lower(), version)
+    name = re.sub(r'[^\w.-]+', '_', name)
+    return os.path.join(os.path.expanduser(directory), name + '.json')
+
+def _selected(name, names):
+    return not names or any(part in name for part in names)
+
+def run_benchmarks(names=None, repeat=10, min_time=0.05):
+    """Run benchmarks, returning the results.
+
+    If names is not None, only the benchmarks whose names contain one
+    of the given strings are run.  The timings of the different
+    benchmarks are interleaved, so a slow period on a busy machine
+    affects one timing of each benchmark rather than every timing of
+    one benchmark.
+    """
+    timers = []
+    for name, setup in BENCHMARKS:
+        if _selected(name, names):
+            timer = timeit.Timer(setup(random.Random(SEED)))
+            timers.append((name, timer, calibrate(timer, min_time)))
+    times = dict((name, []) for name, _, _ in timers)
+    for _ in range(repeat):
+        for name, timer, number in timers:
+            times[name].append(timer.timeit(number) / number)
+    results = {}
+    for name, _, number in timers:
+        name_times = sorted(times[name])
+        results[name] = {
+            'number': number,
+            'best': name_times[0],
+            'median': name_times[len(name_times) // 2],
+        }
+    return {'machine': machine_info(), 'benchmarks': results}
+
+def _format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '{:.3g} {}'.format(seconds * scale, unit)
+    return '{:.3g} ns'.format(seconds * 1e9)
+
+def compare(baseline, results, threshold):
+    """Compare results with a baseline.
+
+    Returns a list of (name, baseline, result, change, regressed),
+    where the times are the best times, and change is the relative
+    change, or None if the benchmark is missing from either.
+    """
+    old = baseline['benchmarks']
+    new = results['benchmarks']
+    rows = []
+    for name in sorted(set(old) | set(new)):
+        old_time = old[name]['best'] if name in old else None
+        new_time = new[name]['best'] if name in new else None
+        if old_time and new_time is not None:
+            change = new_time / old_time - 1
+        else:
+            change = None
+        rows.append((name, old_time, new_time, change,
+                     change is not None and change > threshold))
+    return rows
+
+def _read_json(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError) as ex:
+        error('{}: could not read results: {}'.format(path, ex))
+
+def _write_json(path, results):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        fp.write('\n')
+
+def error(msg):
+    print('error: {}'.format(msg), file=sys.stderr)
+    sys.exit(1)
+
+def run(args):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '-k', '--select',
+        dest='select', action='append', default=[],
+        help='only run benchmarks whose names contain this string')
+    common.add_argument(
+        '--repeat',
+        type=int, default=10,
+        help='number of times to time each benchmark')
+    common.add_argument(
+        '--min-time',
+        dest='min_time', type=float, default=0.05,
+        help='minimum time, in seconds, of each timing')
+    common.add_argument(
+        '--baseline-dir',
+        dest='baseline_dir', default=DEFAULT_BASELINE_DIR,
+        help='directory with the baseline of each machine')
+    parser = argparse.ArgumentParser(prog='python -m header.bench')
+    commands = parser.add_subparsers(dest='command')
+    parser_run = commands.add_parser(
+        'run', parents=[common],
+        help='run the benchmarks')
+    parser_run.add_argument(
+        '-o', '--output',
+        help='write the results to a file')
+    parser_run.add_argument(
+        '--save',
+        action='store_true', default=False,
+        help="save the results as this machine's baseline")
+    parser_compare = commands.add_parser(
+        'compare', parents=[common],
+        help='compare results with a baseline')
+    parser_compare.add_argument(
+        '--baseline',
+        help="baseline results, instead of this machine's baseline")
+    parser_compare.add_argument(
+        '--threshold',
+        type=float, default=15.0,
+        help='percent slowdown which counts as a regression')
+    parser_compare.add_argument(
+        'results',
+        nargs='?',
+        help='results to compare, instead of running the benchmarks')
+    args = parser.parse_args(args)
+    if args.command is None:
+        parser.error('expected a command')
+
+    default_baseline = baseline_path(args.baseline_dir, machine_info())
+    if args.command == 'run':
+        results = run_benchmarks(args.select, args.repeat, args.min_time)
+        for name, _ in BENCHMARKS:
+            if name in results['benchmarks']:
+                result = results['benchmarks'][name]
+                print('{:32} {:>10} {:>10}'.format(
+                    name, _format_time(result['best']),
+                    _format_time(result['median'])))
+        if args.output is not None:
+            _write_json(args.output, results)
+        if args.save:
+            _write_json(default_baseline, results)
+            print('saved baseline: {}'.format(default_baseline))
+        return
+
+    baseline_file = args.baseline or default_baseline
+    if not os.path.exists(baseline_file):
+        error('no baseline: {} (use "run --save" to make one)'
+              .format(baseline_file))
+    baseline = _read_json(baseline_file)
+    if args.results is not None:
+        results = _read_json(args.results)
+    else:
+        results = run_benchmarks(args.select, args.repeat, args.min_time)
+    for data in (baseline, results):
+        data['benchmarks'] = dict(
+            item for item in data['benchmarks'].items()
+            if _selected(item[0], args.select))
+    if baseline.get('machine') != results.get('machine'):
+        print('warning: results are from a different machine than the '
+              'baseline', file=sys.stderr)
+    regressed = False
+    for name, old_time, new_time, change, slower in compare(
+            baseline, results, args.threshold / 100):
+        if change is None:
+            status = 'only in baseline' if new_time is None else 'new'
+            change = ''
+        else:
+            status = 'REGRESSION' if slower else ''
+            change = '{:+.1f}%'.format(change * 100)
+        print('{:32} {:>10} {:>10} {:>8} {}'.format(
+            name,
+            _format_time(old_time) if old_time is not None else '-',
+            _format_time(new_time) if new_time is not None else '-',
+            change, status).rstrip())
+        regressed = regressed or slower
+    if regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        run(sys.argv[1:])
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -53,11 +53,11 @@ def extract_lead_blockcomment(lines, blockstart, blockend):
         if pos >= end:
             return None
         line = lines[pos]
-        pre = ''
+        pre = b''
 
     body = line[:cpos]
     post = line[cpos:]
-    if post[len(blockend)].rstrip():
+    if post[len(blockend):len(blockend)+1].rstrip():
         return None
     comment.append((pre, body, post))
     pos += 1
@@ -124,24 +124,26 @@ def remove_blank_lines(lines):
         send -= 1
     return lines[:spos], lines[spos:send], lines[send:]
 
-def comment(lines, filetype, width):
-    """Convert lines to comments."""
+def comment(lines, filetype, width, newline=b'\n'):
+    """Convert lines to comments.
+
+    Each comment line ends with the given line break.
+    """
     if filetype.blockcomment:
         swidth = len(filetype.blockcomment[0]) + 1
         width = width - swidth
         newlines = []
         numlines = len(lines)
-        for n in xrange(numlines):
+        for n in range(numlines):
             if n == 0:
-                pre = filetype.blockcomment[0] + ' '
+                pre = filetype.blockcomment[0] + b' '
             else:
-                pre = ' ' * swidth
+                pre = b' ' * swidth
             if n == numlines - 1:
-                post = ' ' + filetype.blockcomment[1]
+                post = b' ' + filetype.blockcomment[1]
             else:
-                post = ''
-            newlines.append('{}{}{}\n'.format(
-                pre, lines[n].rstrip(), post))
+                post = b''
+            newlines.append(pre + lines[n].rstrip() + post + newline)
         return newlines
     if filetype.linecomment:
         swidth = len(filetype.linecomment) + 1
@@ -150,8 +152,8 @@ def comment(lines, filetype, width):
         for line in lines:
             line = line.rstrip()
             if line:
-                newlines.append('{} {}\n'.format(filetype.linecomment, line))
+                newlines.append(filetype.linecomment + b' ' + line + newline)
             else:
-                newlines.append('{}\n'.format(filetype.linecomment))
+                newlines.append(filetype.linecomment + newline)
         return newlines
     raise ValueError('cannot comment')
@@ -13,7 +13,10 @@ DIGIT = re.compile(r'\d')
 EXTRA_SPACE = re.compile(r'\s\s+')
 
 class Authorship(object):
-    """Copyright authorship information."""
+    """Copyright authorship information.
+
+    Maps each author to a YearRanges object.
+    """
     __slots__ = ['authors']
 
     def __init__(self):
@@ -22,17 +25,19 @@ class Authorship(object):
     def __nonzero__(self):
         return bool(self.authors)
 
+    __bool__ = __nonzero__
+
     def add_author(self, author, years):
         """Add an author with authorship for the given years."""
         author = author.strip()
         if not author.endswith('.'):
             author += '.'
+        years = year.YearRanges.from_years(years)
         try:
-            yearset = self.authors[author]
+            years = self.authors[author] | years
         except KeyError:
-            yearset = set()
-            self.authors[author] = yearset
-        yearset.update(years)
+            pass
+        self.authors[author] = years.intern()
 
     def parse(self, lines):
         """Parse authorship information from the given lines of text."""
@@ -60,9 +65,7 @@ class Authorship(object):
     def dump(self):
         """Get the authorship information as a list of lines."""
         authors = []
-        for author, years in self.authors.iteritems():
-            years = list(years)
-            years.sort()
+        for author, years in self.authors.items():
             authors.append((years, author))
         authors.sort()
         lines = []
@@ -72,17 +75,27 @@ class Authorship(object):
         return lines
 
 class AutoAuthorship(object):
-    __slots__ = ['root', 'author', 'years']
-    def __init__(self, root, author, years):
+    """Authorship added to files without a copyright notice.
+
+    If the author is not known, it is asked for, or taken from the
+    Git configuration if interactive is false.
+    """
+    __slots__ = ['root', 'author', 'years', 'interactive']
+    def __init__(self, root, author, years, interactive=True):
         self.root = root
         self.author = author
         self.years = years
+        self.interactive = interactive
     def add_authorship(self, authorship):
         if authorship:
             return
         if self.author is None:
-            default = git.get_gitconfig('user', 'name')
-            if default:
+            default = git.get_gitconfig('user', 'name', cwd=self.root)
+            if not self.interactive:
+                if not default:
+                    raise ValueError('unknown copyright author')
+                author = default
+            elif default:
                 author = util.ask('Author name [{}]:'
                                   .format(default), default)
             else:
@@ -90,5 +103,6 @@ class AutoAuthorship(object):
             self.author = author
         if self.years is None:
             import datetime
-            self.years = {datetime.date.today().year}
+            today = datetime.date.today().year
+            self.years = year.YearRanges([(today, today)])
         authorship.add_author(self.author, self.years)
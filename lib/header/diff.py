@@ -4,6 +4,7 @@
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
 import subprocess
+from . import throttle
 from . import util
 import sys
 
@@ -18,9 +19,11 @@ def show_diff(diff):
         else:
             COLORDIFF = colordiff
     if COLORDIFF:
-        proc = subprocess.Popen(
-            [COLORDIFF],
-            stdin=subprocess.PIPE)
-        proc.communicate(diff)
+        sys.stdout.flush()
+        with throttle.subprocess_slot():
+            proc = subprocess.Popen(
+                [COLORDIFF],
+                stdin=subprocess.PIPE)
+            proc.communicate(diff)
     else:
-        sys.stdout.write(diff)
+        util.binary(sys.stdout).write(diff)
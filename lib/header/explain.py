@@ -0,0 +1,89 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Explanations of how the environment for a path is computed."""
+import os
+from . import environ
+from . import scan
+
+def _deciding_pattern(patternset, name, is_dir):
+    """Get the pattern which makes a pattern set match, or None."""
+    found = None
+    for positive, pat in patternset.patterns:
+        if is_dir:
+            match = pat.match_dir(name)[0]
+        else:
+            match = pat.match_file(name)
+        if match:
+            found = positive, pat
+    if found is None or not found[0]:
+        return None
+    return found[1]
+
+def _describe(pat):
+    return '{}: {}'.format(pat.source or '(unknown)', pat)
+
+def _env_lines(env, indent):
+    return ['{}{}'.format(indent,
+                          environ.dump_var(name, value).replace('\n', '\\n'))
+            for name, value in sorted(env.items())
+            if not name.startswith('_')]
+
+def explain(rules, root, parts, excludes, config):
+    """Explain the environment for a path in the work tree.
+
+    The path is given as a list of path components relative to the
+    root.  This follows the same steps as scan_path(), and returns a
+    list of lines describing the configuration files read, the
+    patterns which match each directory and the file, and the
+    resulting environment.
+    """
+    lines = ['/'.join(parts)]
+    path = root
+    for n, fname in enumerate(parts):
+        for fpath, frules in config.load_files(path):
+            lines.append('  read {}'.format(os.path.relpath(fpath, root)))
+            lines.extend(_env_lines(frules.env, '      '))
+            rules = rules.union(frules)
+
+        fpath = os.path.join(path, fname)
+        is_dir = n < len(parts) - 1 or os.path.isdir(fpath)
+        relpath = '/'.join(parts[:n+1]) + ('/' if is_dir else '')
+        if excludes is not None:
+            pat = _deciding_pattern(excludes, fname, is_dir)
+            if pat is not None:
+                lines.append('  {}: excluded by {}'.format(
+                    relpath, _describe(pat)))
+        for segment in rules.segments:
+            for patternset, rule in segment:
+                pat = _deciding_pattern(patternset, fname, is_dir)
+                if pat is None:
+                    continue
+                lines.append('  {}: matches {}'.format(
+                    relpath, _describe(pat)))
+                lines.extend(_env_lines(rule.env, '      '))
+
+        if not is_dir:
+            env = scan._file_env(rules, fname, None, excludes)
+            if env is None:
+                lines.append('  {}: skipped'.format(relpath))
+            else:
+                lines.append('  environment:')
+                lines.extend(_env_lines(env, '      '))
+            return lines
+
+        value = scan._dir_rules(rules, fname, None, excludes)
+        if value is None:
+            lines.append('  {}: skipped'.format(relpath))
+            return lines
+        rules, _, excludes = value
+        if os.path.exists(os.path.join(fpath, '.git')):
+            lines.append('  {}: skipped, contains .git'.format(relpath))
+            return lines
+        path = fpath
+
+    lines.append('  directory, rules:')
+    lines.extend(_env_lines(rules.env, '      '))
+    return lines
@@ -5,6 +5,8 @@
 
 import collections
 import os
+import re
+from . import util
 
 Filetype = collections.namedtuple(
     'Filetype', 'name exts linecomment blockcomment source')
@@ -26,15 +28,159 @@ def _filetype(name, exts, linecomment, blockcomment, source=True):
 
 UNKNOWN = Filetype('unknown', (), None, None, False)
 
-_filetype('h', '.h', '//', '/* */')
-_filetype('hxx', '.hpp .hxx', '//', '/* */')
-_filetype('c', '.c', '//', '/* */')
-_filetype('cxx', '.cp .cpp .cxx', '//', '/* */')
-_filetype('objc', '.m', '//', '/* */')
-_filetype('python', '.py', '#', None)
-_filetype('shell', '.sh', '#', None)
-_filetype('xml', '.xml', None, '<!-- -->', False)
+_filetype('h', '.h', b'//', b'/* */')
+_filetype('hxx', '.hpp .hxx', b'//', b'/* */')
+_filetype('c', '.c', b'//', b'/* */')
+_filetype('cxx', '.cp .cpp .cxx', b'//', b'/* */')
+_filetype('objc', '.m', b'//', b'/* */')
+_filetype('python', '.py', b'#', None)
+_filetype('shell', '.sh', b'#', None)
+_filetype('xml', '.xml', None, b'<!-- -->', False)
 _filetype('text', '.txt', None, None, False)
 
+FILETYPES_ALL = dict(FILETYPES)
+FILETYPES_ALL[UNKNOWN.name] = UNKNOWN
+
 def get_filetype(path):
     return EXTS.get(os.path.splitext(path)[1], UNKNOWN)
+
+# The number of bytes read to sniff the type of a file.
+SNIFF_SIZE = 512
+
+INTERPRETERS = {
+    'python': 'python',
+    'sh': 'shell',
+    'ash': 'shell',
+    'bash': 'shell',
+    'dash': 'shell',
+    'ksh': 'shell',
+    'zsh': 'shell',
+}
+
+MODES = {
+    'c': 'c',
+    'cpp': 'cxx',
+    'c++': 'cxx',
+    'objc': 'objc',
+    'python': 'python',
+    'sh': 'shell',
+    'bash': 'shell',
+    'shell-script': 'shell',
+    'xml': 'xml',
+    'text': 'text',
+}
+
+INTERPRETER_NAME = re.compile(r'[a-z+-]*[a-z+]')
+VIM_MODELINE = re.compile(
+    r'\b(?:vi|vim|ex):.*?\b(?:ft|filetype)=([\w+-]+)')
+EMACS_MODELINE = re.compile(r'-\*-(.*?)-\*-')
+EMACS_MODE = re.compile(r'(?:^|;)\s*mode:\s*([\w+-]+)', re.IGNORECASE)
+
+def sniff_filetype(data):
+    """Get the file type from a file's first few lines.
+
+    This checks for a "#!" line naming a known interpreter, then for a
+    Vim or Emacs modeline in the first lines.
+    """
+    lines = util.decode(data).split('\n')[:5]
+    if lines[0].startswith('#!'):
+        args = lines[0][2:].split()
+        if args and os.path.basename(args[0]) == 'env':
+            args = [arg for arg in args[1:]
+                    if not arg.startswith('-') and '=' not in arg]
+        if args:
+            match = INTERPRETER_NAME.match(os.path.basename(args[0]))
+            if match and match.group() in INTERPRETERS:
+                return FILETYPES[INTERPRETERS[match.group()]]
+    for line in lines:
+        match = VIM_MODELINE.search(line)
+        if match is None:
+            match = EMACS_MODELINE.search(line)
+            if match is not None:
+                mode = match.group(1)
+                if ':' in mode:
+                    match = EMACS_MODE.search(mode)
+                    if match is None:
+                        continue
+                    mode = match.group(1)
+                mode = mode.strip().lower()
+                if mode.endswith('-mode'):
+                    mode = mode[:-5]
+            else:
+                continue
+        else:
+            mode = match.group(1).lower()
+        if mode in MODES:
+            return FILETYPES[MODES[mode]]
+    return UNKNOWN
+
+class Classifier(object):
+    """Determine the types of files in the work tree.
+
+    Files are classified by extension.  Files without an extension
+    are classified by reading the start of the file, and the result
+    is cached by inode and modification time.  The cache can be saved
+    so later runs do not need to read files again.
+    """
+    __slots__ = ['cache_path', 'cache', 'dirty']
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.cache = {}
+        self.dirty = False
+        if cache_path is None:
+            return
+        try:
+            fp = open(cache_path)
+        except IOError:
+            return
+        with fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) == 4 and fields[3] in FILETYPES_ALL:
+                    self.cache[int(fields[0])] = (
+                        fields[1], int(fields[2]), fields[3])
+
+    def classify(self, path):
+        """Classify a file.
+
+        Returns (filetype, data).  If the file was read to find its
+        type and it is a known type, data is the contents of the file,
+        otherwise it is None.
+        """
+        ftype = get_filetype(path)
+        if ftype is not UNKNOWN or os.path.splitext(path)[1]:
+            return ftype, None
+        st = os.stat(path)
+        mtime = repr(st.st_mtime)
+        try:
+            cmtime, csize, name = self.cache[st.st_ino]
+        except KeyError:
+            pass
+        else:
+            if cmtime == mtime and csize == st.st_size:
+                return FILETYPES_ALL[name], None
+        with open(path, 'rb') as fp:
+            data = fp.read(SNIFF_SIZE)
+            ftype = sniff_filetype(data)
+            if ftype is not UNKNOWN and len(data) == SNIFF_SIZE:
+                data += fp.read()
+        self.cache[st.st_ino] = mtime, st.st_size, ftype.name
+        self.dirty = True
+        if ftype is UNKNOWN:
+            data = None
+        return ftype, data
+
+    def save(self):
+        """Save the cache, if it changed."""
+        if self.cache_path is None or not self.dirty:
+            return
+        dirpath = os.path.dirname(self.cache_path)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        tmppath = self.cache_path + '.tmp'
+        with open(tmppath, 'w') as fp:
+            for ino, (mtime, size, name) in sorted(self.cache.items()):
+                fp.write('{} {} {} {}\n'.format(ino, mtime, size, name))
+        os.rename(tmppath, self.cache_path)
+        self.dirty = False
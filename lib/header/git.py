@@ -3,16 +3,144 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+import os
+import shutil
+import struct
 import subprocess
+import tempfile
+from . import util
 
-def get_gitconfig(key, subkey, is_global=False):
+def get_gitconfig(key, subkey, is_global=False, cwd=None):
     cmd = ['git', 'config', '--null']
     if is_global:
         cmd.append('--global')
     cmd.extend(['--get', '{}.{}'.format(key, subkey)])
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE)
     out, err = proc.communicate()
     if proc.returncode:
         return None
-    z = out.index('\0')
-    return out[:z]
+    z = out.index(b'\0')
+    return util.decode(out[:z])
+
+def ls_files(root):
+    """List the entries in the index.
+
+    Returns a list of (mode, sha, path) for each regular file staged
+    at stage 0.  Symbolic links, submodules, and unmerged entries are
+    skipped.
+    """
+    proc = subprocess.Popen(
+        ['git', 'ls-files', '--stage', '-z'],
+        cwd=root, stdout=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise Exception('git ls-files returned {}'.format(proc.returncode))
+    entries = []
+    for record in util.decode(out).split('\0'):
+        if not record:
+            continue
+        info, path = record.split('\t', 1)
+        mode, sha, stage = info.split()
+        if stage != '0' or mode not in ('100644', '100755'):
+            continue
+        entries.append((mode, sha, path))
+    return entries
+
+def index_entry_count(root):
+    """Get the number of entries in the index, or None if unknown.
+
+    Only the header of the index file is read.
+    """
+    path = util.decode(subprocess.check_output(
+        ['git', 'rev-parse', '--git-path', 'index'], cwd=root)).strip()
+    try:
+        with open(os.path.join(root, path), 'rb') as fp:
+            header = fp.read(12)
+    except IOError:
+        return None
+    if len(header) < 12 or header[:4] != b'DIRC':
+        return None
+    return struct.unpack('>I', header[8:12])[0]
+
+class CatFile(object):
+    """Read objects through a persistent "git cat-file --batch" process."""
+    __slots__ = ['proc']
+
+    def __init__(self, root):
+        self.proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, obj):
+        """Get the contents of an object."""
+        self.proc.stdin.write(util.encode(obj + '\n'))
+        self.proc.stdin.flush()
+        fields = self.proc.stdout.readline().split()
+        if len(fields) != 3:
+            raise KeyError(obj)
+        data = self.proc.stdout.read(int(fields[2]))
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+class IndexWriter(object):
+    """Write new blobs and stage them in the index.
+
+    This uses a persistent "git hash-object" process to write blobs
+    and a persistent "git update-index" process to stage them, so the
+    number of processes does not depend on the number of files.  The
+    work tree is not modified.
+    """
+    __slots__ = ['hash_object', 'update_index', 'tmpdir']
+
+    def __init__(self, root):
+        self.hash_object = subprocess.Popen(
+            ['git', 'hash-object', '-w', '--no-filters', '--stdin-paths'],
+            cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.update_index = subprocess.Popen(
+            ['git', 'update-index', '-z', '--index-info'],
+            cwd=root, stdin=subprocess.PIPE)
+        self.tmpdir = tempfile.mkdtemp(prefix='headerfix')
+
+    def write(self, mode, path, data):
+        """Stage new contents for the given path."""
+        tmppath = os.path.join(self.tmpdir, 'blob')
+        with open(tmppath, 'wb') as fp:
+            fp.write(data)
+        self.hash_object.stdin.write(util.encode(tmppath + '\n'))
+        self.hash_object.stdin.flush()
+        sha = util.decode(self.hash_object.stdout.readline().strip())
+        if not sha:
+            raise Exception('git hash-object failed')
+        self.update_index.stdin.write(
+            util.encode('{} {}\t{}\0'.format(mode, sha, path)))
+
+    def close(self):
+        """Finish staging changes."""
+        try:
+            for proc in (self.hash_object, self.update_index):
+                proc.stdin.close()
+                if proc.wait():
+                    raise Exception(
+                        'git returned {}'.format(proc.returncode))
+        finally:
+            shutil.rmtree(self.tmpdir)
+
+def object_sizes(root, objs):
+    """Get a dictionary mapping object names to their sizes."""
+    proc = subprocess.Popen(
+        ['git', 'cat-file', '--batch-check=%(objectname) %(objectsize)'],
+        cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, err = proc.communicate(
+        util.encode(''.join(obj + '\n' for obj in objs)))
+    if proc.returncode:
+        raise Exception('git cat-file returned {}'.format(proc.returncode))
+    sizes = {}
+    for line in util.decode(out).splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            sizes[fields[0]] = int(fields[1])
+    return sizes
@@ -0,0 +1,148 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Git's long-running filter process protocol.
+
+Git starts the filter once and sends it each file as it is staged, so
+configuration stays loaded between files.  To fix files when they are
+staged, configure the filter and select the files with attributes:
+
+    git config filter.headerfix.process 'headerfix --filter-process'
+    echo '*.c filter=headerfix' >> .gitattributes
+
+Messages are pkt-lines: a four digit hexadecimal length, including
+the length itself, followed by the data.  A length of 0000 is a flush
+packet, which ends a list of lines or the contents of a file.  Only
+the "clean" command is supported.
+"""
+from __future__ import print_function
+import os
+import sys
+from . import util
+
+# The largest amount of data in one packet.
+MAX_PACKET = 65516
+
+def _read_packet(fp):
+    """Read a packet, returning None for a flush packet.
+
+    Raises EOFError at the end of the input.
+    """
+    header = fp.read(4)
+    if not header:
+        raise EOFError()
+    try:
+        size = int(header, 16)
+    except ValueError:
+        raise ValueError('invalid packet length: {!r}'.format(header))
+    if size == 0:
+        return None
+    if size < 4 or len(header) != 4:
+        raise ValueError('invalid packet length: {!r}'.format(header))
+    data = fp.read(size - 4)
+    if len(data) != size - 4:
+        raise ValueError('unexpected end of input')
+    return data
+
+def _read_list(fp):
+    """Read text lines until a flush packet."""
+    lines = []
+    while True:
+        data = _read_packet(fp)
+        if data is None:
+            return lines
+        if data.endswith(b'\n'):
+            data = data[:-1]
+        lines.append(util.decode(data))
+
+def _read_contents(fp):
+    """Read binary data until a flush packet."""
+    chunks = []
+    while True:
+        data = _read_packet(fp)
+        if data is None:
+            return b''.join(chunks)
+        chunks.append(data)
+
+def _write_list(fp, lines):
+    for line in lines:
+        line = util.encode(line)
+        fp.write(b'%04x%s\n' % (len(line) + 5, line))
+    fp.write(b'0000')
+
+def _write_contents(fp, data):
+    for pos in range(0, len(data), MAX_PACKET):
+        chunk = data[pos:pos+MAX_PACKET]
+        fp.write(b'%04x' % (len(chunk) + 4))
+        fp.write(chunk)
+    fp.write(b'0000')
+
+class FilterProcess(object):
+    """A filter process which fixes files with the given options.
+
+    The root is the root of the work tree, which paths from Git are
+    relative to.
+    """
+    __slots__ = ['session', 'options', 'root']
+
+    def __init__(self, session, options, root):
+        self.session = session
+        self.options = options
+        self.root = root
+
+    def clean(self, pathname, data):
+        """Fix the contents of a file which is being staged."""
+        result = self.session.process_file(
+            os.path.join(self.root, pathname), data, self.options)
+        if result is None:
+            return data
+        return result.contents
+
+    def handshake(self, infp, outfp):
+        lines = _read_list(infp)
+        if lines[:1] != ['git-filter-client'] or 'version=2' not in lines:
+            raise ValueError('unsupported filter protocol')
+        _write_list(outfp, ['git-filter-server', 'version=2'])
+        outfp.flush()
+        capabilities = _read_list(infp)
+        _write_list(outfp, [line for line in capabilities
+                            if line == 'capability=clean'])
+        outfp.flush()
+
+    def handle(self, infp, outfp):
+        """Handle one command."""
+        keys = {}
+        for line in _read_list(infp):
+            key, _, value = line.partition('=')
+            keys[key] = value
+        data = _read_contents(infp)
+        command = keys.get('command')
+        pathname = keys.get('pathname')
+        try:
+            if command != 'clean':
+                raise ValueError('unsupported command: {}'.format(command))
+            if pathname is None:
+                raise ValueError('missing pathname')
+            data = self.clean(pathname, data)
+        except (ValueError, IOError, OSError) as ex:
+            print('error: {}: {}'.format(pathname, ex), file=sys.stderr)
+            _write_list(outfp, ['status=error'])
+        else:
+            _write_list(outfp, ['status=success'])
+            _write_contents(outfp, data)
+            _write_list(outfp, [])
+        outfp.flush()
+
+    def serve(self, infp, outfp):
+        """Handle commands until the end of the input."""
+        try:
+            self.handshake(infp, outfp)
+            while True:
+                try:
+                    self.handle(infp, outfp)
+                except EOFError:
+                    break
+        finally:
+            self.session.close()
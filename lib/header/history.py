@@ -0,0 +1,568 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Rewriting history from a git fast-export stream.
+
+The stream from git fast-export is read once, and a stream for git
+fast-import is written with the fixed blobs.  Each blob is fixed once
+for each environment it appears in, however many commits contain it.
+Blobs are kept in a temporary file until the commits which use them
+are read.  The tree of each commit is remembered, with its unchanged
+directories shared with its parent's tree, so that the files which a
+changed .gitignore or .header file applies to can be fixed again.
+
+The stream is binary.  Paths are decoded to text when they are read,
+and marks and modes are kept as they appear in the stream.
+"""
+import codecs
+import os
+import tempfile
+from . import archive
+from . import filetype
+from . import sourcefile
+from . import util
+
+# Modes of regular files in file commands.
+FILE_MODES = frozenset([b'100644', b'100755', b'644', b'755'])
+
+def _unquote(path):
+    """Decode a path from a fast-export stream."""
+    if path.startswith(b'"'):
+        path = codecs.escape_decode(path[1:-1])[0]
+    return util.decode(path)
+
+def _split_path(text):
+    """Split a path from the start of a string, returning (path, rest)."""
+    if not text.startswith(b'"'):
+        path, _, rest = text.partition(b' ')
+        return path, rest
+    pos = 1
+    while text[pos:pos+1] != b'"':
+        pos += 2 if text[pos:pos+1] == b'\\' else 1
+    return text[:pos+1], text[pos+2:]
+
+def _under(name, path):
+    """Test whether a name is a path or is inside it."""
+    return name == path or name.startswith(path + '/')
+
+def _data_command(data):
+    return b'data %d\n' % len(data) + data + b'\n'
+
+class _Reader(object):
+    """Reads commands from a fast-export stream."""
+    __slots__ = ['fp', 'pushed']
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushed = None
+
+    def line(self):
+        """Read a line without its line break, or None at the end."""
+        if self.pushed is not None:
+            line = self.pushed
+            self.pushed = None
+            return line
+        line = self.fp.readline()
+        if not line:
+            return None
+        if line.endswith(b'\n'):
+            line = line[:-1]
+        return line
+
+    def need(self):
+        """Read a line, which must exist."""
+        line = self.line()
+        if line is None:
+            raise ValueError('unexpected end of fast-export stream')
+        return line
+
+    def push(self, line):
+        self.pushed = line
+
+    def data(self, line):
+        """Read the contents of a data command."""
+        if not line.startswith(b'data '):
+            raise ValueError('expected data in fast-export stream: {!r}'
+                             .format(line))
+        size = line[5:]
+        if size.startswith(b'<<'):
+            raise ValueError('delimited data is not supported')
+        size = int(size)
+        data = self.fp.read(size)
+        if len(data) != size:
+            raise ValueError('unexpected end of fast-export stream')
+        line = self.line()
+        if line:
+            self.push(line)
+        return data
+
+def _quote(name):
+    """Encode a path for a fast-import stream."""
+    name = util.encode(name)
+    if not name.startswith(b'"') and b'\n' not in name:
+        return name
+    return b'"%s"' % (name.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+                      .replace(b'\n', b'\\n'))
+
+class _TreeEditor(object):
+    """Edits a tree of nested dictionaries without changing the original.
+
+    Files are (mode, ref) tuples.  Each directory is copied at most
+    once, so the trees of different commits share their unchanged
+    directories.
+    """
+    __slots__ = ['root', 'copied']
+
+    def __init__(self, root):
+        self.root = root
+        self.copied = {}
+
+    def _copy(self, node):
+        if id(node) in self.copied:
+            return node
+        node = dict(node)
+        self.copied[id(node)] = node
+        return node
+
+    def _walk(self, parts, create):
+        self.root = node = self._copy(self.root)
+        for part in parts:
+            child = node.get(part)
+            if isinstance(child, dict):
+                child = self._copy(child)
+            elif create:
+                child = self._copy({})
+            else:
+                return None
+            node[part] = child
+            node = child
+        return node
+
+    def set(self, parts, value):
+        self._walk(parts[:-1], True)[parts[-1]] = value
+        if isinstance(value, dict):
+            # The value is now shared, so it must be copied again.
+            self.copied = {}
+
+    def delete(self, parts):
+        node = self._walk(parts[:-1], False)
+        if node is not None:
+            node.pop(parts[-1], None)
+
+    def clear(self):
+        self.root = {}
+        self.copied = {}
+
+def _tree_get(node, parts):
+    """Get a file or directory in a tree, or None."""
+    for part in parts:
+        if not isinstance(node, dict):
+            return None
+        node = node.get(part)
+    return node
+
+def _tree_files(node, prefix):
+    """List the files in a tree as (name, (mode, ref))."""
+    if not isinstance(node, dict):
+        if node is not None:
+            yield prefix, node
+        return
+    for name in sorted(node):
+        for result in _tree_files(node[name], prefix + '/' + name
+                                  if prefix else name):
+            yield result
+
+class HistoryRewriter(object):
+    """Rewrites a fast-export stream.
+
+    Marks are renumbered in the output, since fixed blobs need marks
+    of their own.  The configuration files of each commit are its
+    "state", a sorted tuple of (path, contents), and the rules for
+    each state are computed once.  When a configuration file changes,
+    the files which it applies to are written again, and renames and
+    copies are written as deletions and modifications, since the
+    fixed contents of a file depend on its path.
+    """
+    __slots__ = ['rules', 'excludes', 'reader', 'out', 'spill', 'blobs',
+                 'inline', 'marks', 'last_mark', 'originals', 'fixed',
+                 'commits', 'branches', 'states', 'fixing']
+
+    def __init__(self, rules, excludes, infp, outfp):
+        self.rules = rules
+        self.excludes = excludes
+        self.reader = _Reader(infp)
+        self.out = outfp
+        self.spill = tempfile.TemporaryFile(prefix='headerfix')
+        # Input blob reference -> (offset, size) in the spill file.
+        # Inline data gets references of its own, starting with '@'.
+        self.blobs = {}
+        self.inline = 0
+        # Input commit or tag mark -> output mark.
+        self.marks = {}
+        self.last_mark = 0
+        # Input blob reference -> output reference of the unchanged blob.
+        self.originals = {}
+        # (input blob reference, file type, environment) -> output ref.
+        self.fixed = {}
+        # Input commit mark -> (state, tree).
+        self.commits = {}
+        # Branch -> (state, tree) of its last commit.
+        self.branches = {}
+        # State -> ArchiveRules.
+        self.states = {}
+        self.fixing = True
+
+    def close(self):
+        self.spill.close()
+
+    def _new_mark(self):
+        self.last_mark += 1
+        return self.last_mark
+
+    def _ref(self, ref):
+        """Translate a commit reference to the output."""
+        if not ref.startswith(b':'):
+            return ref
+        try:
+            return b':%d' % self.marks[int(ref[1:])]
+        except KeyError:
+            raise ValueError('unknown mark in fast-export stream: {}'
+                             .format(util.decode(ref)))
+
+    def _parent(self, ref):
+        """Get the (state, tree) of a commit."""
+        if ref.startswith(b':'):
+            return self.commits.get(int(ref[1:]), ((), {}))
+        return self.branches.get(ref, ((), {}))
+
+    def _store_blob(self, ref, data):
+        self.spill.seek(0, 2)
+        self.blobs[ref] = self.spill.tell(), len(data)
+        self.spill.write(data)
+
+    def _store_inline(self, data):
+        self.inline += 1
+        ref = b'@%d' % self.inline
+        self._store_blob(ref, data)
+        return ref
+
+    def _read_blob(self, ref):
+        """Read a blob by reference, or return None if it is unknown."""
+        try:
+            offset, size = self.blobs[ref]
+        except KeyError:
+            return None
+        self.spill.seek(offset)
+        return self.spill.read(size)
+
+    def _write_blob(self, data):
+        mark = self._new_mark()
+        self.out.write(b'blob\nmark :%d\n' % mark)
+        self.out.write(_data_command(data))
+        return b':%d' % mark
+
+    def _original(self, ref):
+        """Get the output reference for an unchanged blob."""
+        if ref not in self.blobs:
+            if ref.startswith(b':'):
+                raise ValueError('unknown mark in fast-export stream: {}'
+                                 .format(util.decode(ref)))
+            return ref
+        try:
+            return self.originals[ref]
+        except KeyError:
+            pass
+        out = self._write_blob(self._read_blob(ref))
+        self.originals[ref] = out
+        return out
+
+    def _arules(self, state):
+        try:
+            return self.states[state]
+        except KeyError:
+            pass
+        arules = archive.ArchiveRules(self.rules, self.excludes)
+        for name, data in state:
+            arules.add_config(archive.member_parts(name), data)
+        self.states[state] = arules
+        return arules
+
+    def _source(self, arules, name, ref):
+        """Get the source file for a blob, or None."""
+        parts = archive.member_parts(name)
+        if not parts or parts[-1] in archive.CONFIG_READERS:
+            return None
+        env = arules.file_env(parts)
+        if env is None:
+            return None
+        ftype = filetype.get_filetype(parts[-1])
+        data = None
+        if ftype.name == 'unknown' and not os.path.splitext(parts[-1])[1]:
+            data = self._read_blob(ref)
+            ftype = filetype.sniff_filetype(data[:filetype.SNIFF_SIZE])
+        if ftype.name == 'unknown':
+            return None
+        if data is None:
+            data = self._read_blob(ref)
+        return sourcefile.BlobFile(env, ftype, data, name)
+
+    def _modify(self, arules, mode, ref, name):
+        """Yield the source file for a blob, then its output reference."""
+        src = None
+        if self.fixing and mode in FILE_MODES and ref in self.blobs:
+            src = self._source(arules, name, ref)
+        if src is None:
+            if mode == b'160000':
+                yield ref
+            else:
+                yield self._original(ref)
+            return
+        key = (ref, src.filetype.name,
+               tuple(sorted(item for item in src.env.items()
+                            if item[0] != '_authorship')))
+        try:
+            yield self.fixed[key]
+            return
+        except KeyError:
+            pass
+        yield src
+        if src.saved and src.changed():
+            out = self._write_blob(src.contents())
+        else:
+            out = self._original(ref)
+        self.fixed[key] = out
+        yield out
+
+    def _blob(self):
+        reader = self.reader
+        mark = None
+        while True:
+            line = reader.need()
+            if line.startswith(b'mark :'):
+                mark = line[5:]
+            elif line.startswith(b'data '):
+                break
+        data = reader.data(line)
+        if mark is not None:
+            self._store_blob(mark, data)
+
+    def _header(self, line):
+        """Read the lines of a command up to its data."""
+        reader = self.reader
+        head = [line + b'\n']
+        mark = None
+        while True:
+            line = reader.need()
+            if line.startswith(b'mark :'):
+                mark = int(line[6:])
+                self.marks[mark] = self._new_mark()
+                head.append(b'mark :%d\n' % self.marks[mark])
+            elif line.startswith(b'from '):
+                head.append(b'from %s\n' % self._ref(line[5:]))
+            elif line.startswith(b'data '):
+                break
+            else:
+                head.append(line + b'\n')
+        head.append(_data_command(reader.data(line)))
+        return mark, head
+
+    def _file_commands(self, tree):
+        """Read a commit's file commands.
+
+        Returns (commands, tree, touched), where commands is a list of
+        output lines and of ('M', mode, ref, name) for files whose
+        output reference is not known yet, and touched is the set of
+        paths which changed, or None if the tree was cleared.
+        """
+        reader = self.reader
+        editor = _TreeEditor(tree)
+        commands = []
+        touched = set()
+        while True:
+            line = reader.line()
+            if line is None or line == b'':
+                break
+            elif line.startswith(b'M '):
+                mode, ref, path = line[2:].split(b' ', 2)
+                if ref == b'inline':
+                    ref = self._store_inline(reader.data(reader.need()))
+                name = _unquote(path)
+                editor.set(archive.member_parts(name), (mode, ref))
+                touched.add(name)
+                commands.append(('M', mode, ref, name))
+            elif line.startswith(b'D '):
+                name = _unquote(line[2:])
+                editor.delete(archive.member_parts(name))
+                touched.add(name)
+                commands.append(line + b'\n')
+            elif line.startswith((b'R ', b'C ')):
+                src, dest = _split_path(line[2:])
+                src = _unquote(src)
+                dest = _unquote(dest)
+                value = _tree_get(editor.root, archive.member_parts(src))
+                if value is None:
+                    continue
+                if line.startswith(b'R '):
+                    editor.delete(archive.member_parts(src))
+                    touched.add(src)
+                    commands.append(b'D %s\n' % _quote(src))
+                editor.set(archive.member_parts(dest), value)
+                touched.add(dest)
+                for name, (mode, ref) in _tree_files(value, dest):
+                    commands.append(('M', mode, ref, name))
+            elif line == b'deleteall':
+                editor.clear()
+                touched = None
+                commands.append(line + b'\n')
+            elif line.startswith(b'N '):
+                ref, commit = line[2:].split(b' ', 1)
+                if ref == b'inline':
+                    ref = self._store_inline(reader.data(reader.need()))
+                commands.append(b'N %s %s\n' % (
+                    self._original(ref), self._ref(commit)))
+            else:
+                reader.push(line)
+                break
+        return commands, editor.root, touched
+
+    def _state(self, state, tree, touched):
+        """Get the state of a tree after the given paths changed."""
+        if touched is None:
+            configs = {}
+            touched = ['']
+        else:
+            configs = dict(state)
+            for path in touched:
+                for name in [name for name in configs
+                             if _under(name, path)]:
+                    del configs[name]
+        for path in touched:
+            node = _tree_get(tree, archive.member_parts(path))
+            for name, (mode, ref) in _tree_files(node, path):
+                parts = archive.member_parts(name)
+                if (parts[-1] in archive.CONFIG_READERS and
+                        mode in FILE_MODES and ref in self.blobs):
+                    configs[name] = self._read_blob(ref)
+        configs = tuple(sorted(configs.items()))
+        if configs == state:
+            return state
+        return configs
+
+    def _commit(self, line):
+        reader = self.reader
+        branch = line[7:]
+        mark, head = self._header(line)
+        state, tree = self.branches.get(branch, ((), {}))
+        line = reader.line()
+        if line is not None and line.startswith(b'from '):
+            state, tree = self._parent(line[5:])
+            head.append(b'from %s\n' % self._ref(line[5:]))
+            line = reader.line()
+        while line is not None and line.startswith(b'merge '):
+            head.append(b'merge %s\n' % self._ref(line[6:]))
+            line = reader.line()
+        if line:
+            reader.push(line)
+
+        commands, new_tree, touched = self._file_commands(tree)
+        names = set(command[3] for command in commands
+                    if isinstance(command, tuple))
+        new_state = self._state(state, new_tree, touched)
+        if new_state != state:
+            # Write the files which the changed configuration applies
+            # to again, since they may need different fixes.
+            old = dict(state)
+            new = dict(new_state)
+            dirs = set(tuple(archive.member_parts(name)[:-1])
+                       for name in set(old) | set(new)
+                       if old.get(name) != new.get(name))
+            for dirparts in sorted(dirs):
+                prefix = '/'.join(dirparts)
+                for name, (mode, ref) in _tree_files(
+                        _tree_get(new_tree, dirparts), prefix):
+                    if name not in names:
+                        names.add(name)
+                        commands.append(('M', mode, ref, name))
+        state = new_state
+        tree = new_tree
+
+        arules = self._arules(state)
+        tail = []
+        for command in commands:
+            if not isinstance(command, tuple):
+                tail.append(command)
+                continue
+            _, mode, ref, name = command
+            for out in self._modify(arules, mode, ref, name):
+                if isinstance(out, sourcefile.SourceFile):
+                    yield out
+            tail.append(b'M %s %s %s\n' % (mode, out, _quote(name)))
+        self.out.writelines(head)
+        self.out.writelines(tail)
+        self.out.write(b'\n')
+        if mark is not None:
+            self.commits[mark] = state, tree
+        self.branches[branch] = state, tree
+
+    def _tag(self, line):
+        mark, head = self._header(line)
+        self.out.writelines(head)
+
+    def _reset(self, line):
+        branch = line[6:]
+        self.out.write(line + b'\n')
+        line = self.reader.line()
+        if line is not None and line.startswith(b'from '):
+            self.branches[branch] = self._parent(line[5:])
+            self.out.write(b'from %s\n' % self._ref(line[5:]))
+        else:
+            self.branches.pop(branch, None)
+            if line:
+                self.reader.push(line)
+        self.out.write(b'\n')
+
+    def run(self):
+        """Rewrite the stream, yielding a BlobFile for each fix."""
+        reader = self.reader
+        while True:
+            line = reader.line()
+            if line is None:
+                break
+            elif line == b'':
+                continue
+            elif line == b'blob':
+                self._blob()
+            elif line.startswith(b'commit '):
+                for src in self._commit(line):
+                    yield src
+            elif line.startswith(b'tag '):
+                self._tag(line)
+            elif line.startswith(b'reset '):
+                self._reset(line)
+            else:
+                self.out.write(line + b'\n')
+        self.out.flush()
+
+def rewrite(rules, excludes, infp, outfp):
+    """Rewrite history from a git fast-export stream.
+
+    Yields a BlobFile for each blob which is a source file, once for
+    each distinct environment.  Blobs which are saved are changed in
+    the stream written to outfp.  If the caller stops early, the rest
+    of the stream is copied unchanged.
+    """
+    rewriter = HistoryRewriter(rules, excludes, infp, outfp)
+    try:
+        sources = rewriter.run()
+        for src in sources:
+            try:
+                yield src
+            except GeneratorExit:
+                rewriter.fixing = False
+                for src in sources:
+                    pass
+                raise
+    finally:
+        rewriter.close()
@@ -0,0 +1,285 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Memoization of fixes for files with identical contents.
+
+Trees often contain many copies of the same file, such as vendored
+headers or generated boilerplate.  Fixing a file depends only on its
+contents, its file type, and its environment.  The one part of the
+environment which depends on the file's path is the header guard
+name, so fixes are computed with a placeholder guard name, and the
+file's own guard name is substituted into the cached result.
+
+Most files in a tree which is already fixed also share their header
+and footer: the copyright notice, header guard, and extern "C" lines.
+A HeaderCache remembers these for files which did not change, and
+checks other files by comparing their first and last bytes, so the
+filters only run when a file might need changes.
+"""
+import collections
+import hashlib
+from . import comment
+from . import sourcefile
+from . import util
+
+GUARD_PLACEHOLDER = b'\0HEADERFIX_GUARDNAME\0'
+
+# Environment variables which are not part of the cache key.
+PATH_VARS = frozenset(['guardname', '_authorship'])
+
+# The body used to find the header and footer which the filters add.
+SENTINEL = b'HEADERFIX_SENTINEL'
+
+def _first_line(data):
+    pos = data.find(b'\n')
+    if pos < 0:
+        return data
+    return data[:pos+1]
+
+def _last_line(data):
+    pos = data.rfind(b'\n', 0, len(data) - 1)
+    return data[pos+1:]
+
+class HeaderCache(object):
+    """A cache of the headers and footers of files which are fixed.
+
+    The filters treat the body of a file, between the header and
+    footer, as opaque text, with a few exceptions.  They look at
+    whether its first and last lines are blank, whether its first
+    line is a comment or starts a header guard, unless it follows a
+    header guard, and whether it contains an extern "C" block.  A
+    file whose body has none of these features is fixed if its
+    header and footer are the same as the header and footer which
+    the filters put around a body which consists of a single
+    sentinel line.
+    """
+    __slots__ = ['size', 'entries', 'hits']
+
+    # The number of different headers remembered for each key.
+    CANDIDATES = 4
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+
+    def _key(self, src, shebang):
+        env = src.env
+        return (
+            src.filetype.name,
+            src.newline,
+            shebang,
+            bool(env['guardname']),
+            tuple(sorted(item for item in env.items()
+                         if item[0] not in PATH_VARS)),
+        )
+
+    def _safe_body(self, src, body, footer):
+        """Test whether the filters treat a body like the sentinel."""
+        if not body or (footer and not body.endswith(b'\n')):
+            return False
+        first = _first_line(body)
+        last = _last_line(body)
+        if not first.strip() or not last.strip():
+            return False
+        first = first.lstrip()
+        ftype = src.filetype
+        env = src.env
+        # After a header guard, the first line is not part of the lead
+        # comments, and cannot be taken for the guard.
+        if not (ftype.name in ('h', 'hxx') and
+                env['guards'] and env['guardname']):
+            if ftype.linecomment and first.startswith(ftype.linecomment):
+                return False
+            if (ftype.blockcomment and
+                first.startswith(ftype.blockcomment[0])):
+                return False
+            if first.startswith(b'#ifndef'):
+                return False
+        if (ftype.name == 'h' and env['extern_c'] and
+            sourcefile.ExternC.head[0] in body):
+            return False
+        return True
+
+    def check(self, src, whitespace=False):
+        """Test whether a file is already fixed, without changing it.
+
+        Returns True if the file is fixed.  Otherwise, the file must be
+        fixed to find out, and this returns False if its header and
+        footer should be learned afterwards, or None if learning them
+        would not help, because they are known already or because
+        files like it are never checked.
+        """
+        data = src.orig
+        if GUARD_PLACEHOLDER in data:
+            return None
+        if whitespace:
+            if src.newline != b'\n' or b'\t' in data:
+                return None
+            if not sourcefile.is_clean(data):
+                return None
+        if data.startswith(b'#!'):
+            shebang = _first_line(data)
+            data = data[len(shebang):]
+        else:
+            shebang = None
+        key = self._key(src, shebang is not None)
+        try:
+            candidates = self.entries[key]
+        except KeyError:
+            return False
+        guardname = util.encode(src.env['guardname'])
+        for n, candidate in enumerate(candidates):
+            header, footer = candidate
+            if guardname:
+                header = header.replace(GUARD_PLACEHOLDER, guardname)
+                footer = footer.replace(GUARD_PLACEHOLDER, guardname)
+            if (len(data) < len(header) + len(footer) or
+                not data.startswith(header) or
+                not data.endswith(footer)):
+                continue
+            body = data[len(header):len(data)-len(footer)]
+            if not self._safe_body(src, body, footer):
+                return None
+            if n:
+                del candidates[n]
+                candidates.insert(0, candidate)
+            self.hits += 1
+            return True
+        return False
+
+    def _render(self, src, data):
+        env = dict(src.env)
+        if env['guardname']:
+            env['guardname'] = GUARD_PLACEHOLDER
+        rsrc = sourcefile.SourceFile(
+            src.path, src.relpath, env, src.filetype, data)
+        rsrc.fix()
+        return rsrc.contents()
+
+    def learn(self, src):
+        """Remember the header and footer of a file which is fixed."""
+        data = src.orig
+        if GUARD_PLACEHOLDER in data or SENTINEL in data:
+            return
+        newline = src.newline
+        if data.startswith(b'#!'):
+            shebang = _first_line(data)
+            data = data[len(shebang):]
+        else:
+            shebang = None
+        lead = []
+        if src.filetype.source:
+            lead, body = comment.extract_lead_comment(
+                sourcefile.split_lines(data), src.filetype)
+        sentinel = (
+            (b'#!' + SENTINEL + newline if shebang is not None else b'') +
+            b''.join(pre + body + post for pre, body, post in lead) +
+            SENTINEL + newline)
+        rendered = self._render(src, sentinel)
+        if self._render(src, rendered) != rendered:
+            return
+        if shebang is not None:
+            rendered = rendered[len(_first_line(rendered)):]
+        sentinel = SENTINEL + newline
+        pos = rendered.find(sentinel)
+        if pos < 0 or rendered.find(sentinel, pos + 1) >= 0:
+            return
+        header = rendered[:pos]
+        footer = rendered[pos+len(sentinel):]
+        key = self._key(src, shebang is not None)
+        candidates = self.entries.pop(key, [])
+        self.entries[key] = candidates
+        if (header, footer) in candidates:
+            return
+        candidates.insert(0, (header, footer))
+        del candidates[self.CANDIDATES:]
+        while len(self.entries) > self.size:
+            self.entries.popitem(False)
+
+class FixCache(object):
+    """A least-recently-used cache of fixed file contents.
+
+    Files which are already fixed are found with a HeaderCache when
+    possible, without running the filters.  A size of zero or less
+    disables both caches.
+    """
+    __slots__ = ['size', 'entries', 'headers', 'hits', 'misses']
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.headers = HeaderCache()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, src, whitespace, data=None):
+        """Get the cache key for a source file.
+
+        The data is the original contents, or a precomputed digest of
+        them.
+        """
+        if data is None:
+            data = hashlib.sha1(src.orig).digest()
+        env = src.env
+        authorship = env['_authorship']
+        return (
+            data,
+            src.filetype.name,
+            whitespace,
+            bool(env['guardname']),
+            getattr(authorship, 'author', None),
+            getattr(authorship, 'years', None),
+            tuple(sorted(item for item in env.items()
+                         if item[0] not in PATH_VARS)),
+        )
+
+    def fix(self, src, whitespace=False):
+        """Fix a source file, using cached results when possible."""
+        if self.size <= 0:
+            src.fix(whitespace)
+            return
+        known = self.headers.check(src, whitespace)
+        if known:
+            return
+        self._fix(src, whitespace)
+        if known is not None and not src.changed():
+            self.headers.learn(src)
+
+    def _fix(self, src, whitespace):
+        if GUARD_PLACEHOLDER in src.orig:
+            src.fix(whitespace)
+            return
+        digest = hashlib.sha1(src.orig).digest()
+        guardname = src.env['guardname']
+        key = self.key(src, whitespace, digest)
+        try:
+            data = self.entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self.entries[key] = data
+            if guardname:
+                data = data.replace(GUARD_PLACEHOLDER, util.encode(guardname))
+            src.set_contents(data)
+            return
+
+        self.misses += 1
+        if guardname:
+            src.env['guardname'] = GUARD_PLACEHOLDER
+        try:
+            src.fix(whitespace)
+        finally:
+            src.env['guardname'] = guardname
+        data = src.contents()
+        # Fixing a file can change the authorship state, for example
+        # by asking for the author's name, so use the updated key.
+        self.entries[self.key(src, whitespace, digest)] = data
+        while len(self.entries) > self.size:
+            self.entries.popitem(False)
+        if guardname:
+            src.set_contents(data.replace(GUARD_PLACEHOLDER,
+                                          util.encode(guardname)))
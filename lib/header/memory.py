@@ -0,0 +1,297 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Memory use of each phase of a run, and of each file.
+
+Memory is only measured while a MemoryStats object is installed,
+which replaces the functions doing the work of each phase with
+measuring versions, like stats.PatternStats does for patterns.  The
+phases are:
+
+    scan: listing directories and the index
+    rules: reading configuration files and computing environments
+    read: reading files
+    filter: fixing files
+    diff: computing diffs
+    write: saving files
+
+Work outside these functions, such as reporting long lines, is
+counted as "other".  The peak RSS of the process is read with
+getrusage(), and is kept for each phase along with how much the
+phase raised it.  Where tracemalloc can measure the peak between two
+points (Python 3.9 and later), the peak of traced Python allocations
+is kept for each phase and for each file, otherwise only the RSS is
+measured.  Tracing allocations makes the run several times slower.
+Only the main thread is measured, so with more than one scan thread
+the directories listed by the other threads are not counted.
+"""
+import os
+import sys
+import threading
+from . import archive
+from . import filetype
+from . import git
+from . import history
+from . import memo
+from . import rule
+from . import scan
+from . import sourcefile
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PHASES = ['scan', 'rules', 'read', 'filter', 'diff', 'write', 'other']
+
+def _src_key(src, *args):
+    return src.relpath
+
+# (object, attribute, phase, key) for each measured function, where
+# key gets the file from the function's arguments, or is None.
+HOOKS = [
+    (scan, '_list_dir', 'scan', None),
+    (git, 'ls_files', 'scan', None),
+    (scan.ConfigCache, '_read', 'rules', None),
+    (archive.ArchiveRules, 'add_config', 'rules', None),
+    (rule.Rules, 'dir_rules', 'rules', None),
+    (rule.Rules, 'file_env', 'rules', None),
+    (filetype.Classifier, 'classify', 'read',
+     lambda self, path: os.path.relpath(path)),
+    (sourcefile.SourceFile, '__init__', 'read',
+     lambda self, path, relpath, *args: relpath),
+    (git.CatFile, 'read', 'read', None),
+    (archive, '_source', 'read', None),
+    (history.HistoryRewriter, '_read_blob', 'read', None),
+    (memo.FixCache, 'fix', 'filter', lambda self, src, *args: src.relpath),
+    (sourcefile.SourceFile, 'diff', 'diff', _src_key),
+    (sourcefile.BufferFile, 'diff', 'diff', _src_key),
+    (sourcefile.IndexFile, 'diff', 'diff', _src_key),
+    (sourcefile.ArchiveFile, 'diff', 'diff', _src_key),
+    (sourcefile.BlobFile, 'diff', 'diff', _src_key),
+    (sourcefile.SourceFile, 'save', 'write', _src_key),
+    (sourcefile.IndexFile, 'save', 'write', _src_key),
+    (sourcefile.ArchiveFile, 'save', 'write', _src_key),
+]
+
+def max_rss():
+    """Get the peak RSS of the process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS reports bytes.
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+def _format_size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'kB', 'MB'):
+        if size < 1000:
+            return '{:.0f} {}'.format(size, unit)
+        size /= 1000.0
+    return '{:.1f} GB'.format(size)
+
+class Phase(object):
+    """The memory use of one phase."""
+    __slots__ = ['name', 'calls', 'traced_peak', 'rss_peak', 'rss_growth']
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.traced_peak = None
+        self.rss_peak = None
+        self.rss_growth = 0
+
+    def to_json(self):
+        return {
+            'calls': self.calls,
+            'traced_peak': self.traced_peak,
+            'rss_peak': self.rss_peak,
+            'rss_growth': self.rss_growth,
+        }
+
+class MemoryStats(object):
+    """Measures the memory used by each phase of a run and each file.
+
+    The files are kept by the peak of allocations made while working
+    on them, above what was allocated before.  Only the limit files
+    with the largest peaks are kept.
+    """
+    __slots__ = ['limit', 'phases', 'files', 'stack', 'rss', 'tracing',
+                 'started', 'saved', 'thread']
+
+    def __init__(self, limit=20):
+        self.limit = limit
+        self.phases = dict((name, Phase(name)) for name in PHASES)
+        self.files = {}
+        # [phase, traced memory at entry, traced peak] for each
+        # measured call in progress.
+        self.stack = []
+        self.rss = None
+        self.tracing = (tracemalloc is not None and
+                        hasattr(tracemalloc, 'reset_peak'))
+        self.started = False
+        self.saved = None
+        self.thread = None
+
+    def install(self):
+        """Start measuring memory."""
+        if self.saved is not None:
+            return
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+        self.thread = threading.current_thread()
+        self.rss = max_rss()
+        self.saved = []
+        for obj, attr, phase, key in HOOKS:
+            func = obj.__dict__[attr]
+            self.saved.append((obj, attr, func))
+            setattr(obj, attr, self._wrap(func, phase, key))
+        self._switch()
+
+    def uninstall(self):
+        """Stop measuring memory."""
+        if self.saved is None:
+            return
+        self._switch()
+        for obj, attr, func in reversed(self.saved):
+            setattr(obj, attr, func)
+        self.saved = None
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def _wrap(self, func, phase, key):
+        stats = self
+
+        def measured(*args, **kw):
+            if threading.current_thread() is not stats.thread:
+                return func(*args, **kw)
+            stats._enter(phase)
+            try:
+                return func(*args, **kw)
+            finally:
+                stats._exit(key(*args) if key is not None else None)
+
+        measured.__name__ = func.__name__
+        measured.__doc__ = func.__doc__
+        return measured
+
+    def _switch(self):
+        """Record the memory used since the last switch.
+
+        The memory is counted for the current phase, and the traced
+        peak is counted for every call in progress.
+        """
+        phase = self.phases[self.stack[-1][0] if self.stack else 'other']
+        rss = max_rss()
+        if rss is not None:
+            phase.rss_peak = max(phase.rss_peak or 0, rss)
+            phase.rss_growth += rss - self.rss
+            self.rss = rss
+        if self.tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            phase.traced_peak = max(phase.traced_peak or 0, peak)
+            for entry in self.stack:
+                entry[2] = max(entry[2], peak)
+            tracemalloc.reset_peak()
+
+    def _enter(self, name):
+        self._switch()
+        current = 0
+        if self.tracing:
+            current = tracemalloc.get_traced_memory()[0]
+        self.stack.append([name, current, current])
+        self.phases[name].calls += 1
+
+    def _exit(self, key):
+        self._switch()
+        name, start, peak = self.stack.pop()
+        if key is None or not self.tracing:
+            return
+        used = peak - start
+        if used > self.files.get(key, -1):
+            self.files[key] = used
+        if len(self.files) > max(self.limit * 4, 1000):
+            self.files = dict(self.top_files())
+
+    def top_files(self):
+        """Get (path, traced peak) for the files which used the most."""
+        files = sorted(self.files.items(), key=lambda item: (-item[1],
+                                                             item[0]))
+        if self.limit:
+            files = files[:self.limit]
+        return files
+
+    def to_json(self):
+        return {
+            'rss_peak': max_rss(),
+            'traced': self.tracing,
+            'phases': dict((name, phase.to_json())
+                           for name, phase in self.phases.items()),
+            'files': [{'path': path, 'traced_peak': used}
+                      for path, used in self.top_files()],
+        }
+
+    def write(self, fp):
+        """Write tables of the memory used by each phase and file."""
+        write_json(fp, self.to_json())
+
+def write_json(fp, data):
+    """Write tables of memory use from the JSON form of MemoryStats."""
+    fp.write('{:8} {:>10} {:>12} {:>12} {:>12}\n'.format(
+        'phase', 'calls', 'traced peak', 'RSS peak', 'RSS growth'))
+    for name in PHASES:
+        phase = data['phases'][name]
+        fp.write('{:8} {:>10} {:>12} {:>12} {:>12}\n'.format(
+            name, phase['calls'], _format_size(phase['traced_peak']),
+            _format_size(phase['rss_peak']),
+            _format_size(phase['rss_growth'])))
+    fp.write('peak RSS: {}\n'.format(_format_size(data['rss_peak'])))
+    if data['files']:
+        fp.write('{:>12}  {}\n'.format('traced peak', 'file'))
+        for item in data['files']:
+            fp.write('{:>12}  {}\n'.format(
+                _format_size(item['traced_peak']), item['path']))
+
+def merge_json(items):
+    """Merge the JSON form of MemoryStats from different shards.
+
+    Peaks are the largest peak of any shard, and the files are the
+    files which used the most in any shard.
+    """
+    items = list(items)
+    if not items:
+        return None
+    limit = max(len(data['files']) for data in items)
+    phases = {}
+    for name in PHASES:
+        merged = {'calls': 0, 'traced_peak': None, 'rss_peak': None,
+                  'rss_growth': None}
+        for data in items:
+            phase = data['phases'].get(name)
+            if phase is None:
+                continue
+            merged['calls'] += phase['calls']
+            for field in ('traced_peak', 'rss_peak', 'rss_growth'):
+                if phase[field] is not None:
+                    merged[field] = max(merged[field] or 0, phase[field])
+        phases[name] = merged
+    rss_peaks = [data['rss_peak'] for data in items
+                 if data['rss_peak'] is not None]
+    files = sorted((item for data in items for item in data['files']),
+                   key=lambda item: (-item['traced_peak'], item['path']))
+    return {
+        'rss_peak': max(rss_peaks) if rss_peaks else None,
+        'traced': all(data['traced'] for data in items),
+        'phases': phases,
+        'files': files[:limit],
+    }
@@ -4,6 +4,7 @@
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
 """Patterns for matching file paths."""
+from __future__ import print_function
 import fnmatch
 
 class PathPattern(object):
@@ -16,12 +17,17 @@ class PathPattern(object):
     For example, the rooted pattern "/a/*" matches "/a/b" but not
     "/dir/a/b".  The unrooted pattern "a/*" matches both "/a/b" and
     "/dir/a/b".
+
+    The source is where the pattern was written, such as
+    ".gitignore:3", or None.  Patterns derived from this pattern for
+    subdirectories have the same source.
     """
-    __slots__ = ['rooted', 'parts']
+    __slots__ = ['rooted', 'parts', 'source']
 
-    def __init__(self, rooted, parts):
+    def __init__(self, rooted, parts, source=None):
         self.rooted = bool(rooted)
         self.parts = tuple(parts)
+        self.source = source
         assert self.parts
 
     def match_dir(self, name):
@@ -38,7 +44,8 @@ class PathPattern(object):
                 (len(self.parts) == 2 and not self.parts[1])):
                 match = True
             else:
-                patterns.append(self.__class__(True, self.parts[1:]))
+                patterns.append(
+                    self.__class__(True, self.parts[1:], self.source))
         if not self.rooted:
             patterns.append(self)
         return match, patterns
@@ -53,13 +60,13 @@ class PathPattern(object):
         return '/' + pat if self.rooted else pat
 
     @classmethod
-    def parse(class_, string):
+    def parse(class_, string, source=None):
         directory = string.endswith('/')
         rooted = string.startswith('/')
         parts = [part for part in string.split('/') if part]
         if directory:
             parts.append('')
-        return class_(rooted, parts)
+        return class_(rooted, parts, source)
 
     @staticmethod
     def match_part(fname, pattern):
@@ -89,21 +96,34 @@ class PatternSet(object):
     def __nonzero__(self):
         return bool(self.patterns)
 
+    __bool__ = __nonzero__
+
     def match_dir(self, name):
         """Apply the pattern set against a directory.
 
         Returns (match, patternset), where "match" is true if the
         directory itself matches the pattern, and "patternset" is a
-        new patternset relative to the directory.
+        new patternset relative to the directory.  If no pattern
+        changes, the pattern set itself is returned rather than a
+        copy, so unrooted patterns are shared by all subdirectories.
         """
-        dir_patterns = []
+        dir_patterns = None
         dir_match = False
-        for positive, pattern in self.patterns:
+        for n, item in enumerate(self.patterns):
+            positive, pattern = item
             pat_match, pat_patterns = pattern.match_dir(name)
-            dir_patterns.extend(
-                (positive, pat_pattern) for pat_pattern in pat_patterns)
             if pat_match:
                 dir_match = positive
+            if len(pat_patterns) == 1 and pat_patterns[0] is pattern:
+                if dir_patterns is not None:
+                    dir_patterns.append(item)
+            else:
+                if dir_patterns is None:
+                    dir_patterns = list(self.patterns[:n])
+                dir_patterns.extend(
+                    (positive, pat_pattern) for pat_pattern in pat_patterns)
+        if dir_patterns is None:
+            return dir_match, self
         return dir_match, PatternSet(dir_patterns)
 
     def match_file(self, name):
@@ -123,7 +143,7 @@ class PatternSet(object):
         return PatternSet(self.patterns, other.patterns)
 
     @classmethod
-    def parse(class_, strings):
+    def parse(class_, strings, source=None):
         """Make a pattern set by parsing a list of strings as patterns."""
         patterns = []
         for string in strings:
@@ -134,7 +154,7 @@ class PatternSet(object):
                     continue
             else:
                 positive = True
-            patterns.append((positive, GlobPattern.parse(string)))
+            patterns.append((positive, GlobPattern.parse(string, source)))
         return class_(patterns)
 
     @classmethod
@@ -144,7 +164,7 @@ class PatternSet(object):
         This tries to use the same syntax as gitignore files.
         """
         patterns = []
-        for line in fp:
+        for lineno, line in enumerate(fp, 1):
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
@@ -153,13 +173,14 @@ class PatternSet(object):
                 line = line[1:]
             else:
                 positive = True
-            patterns.append((positive, GlobPattern.parse(line)))
+            patterns.append((positive, GlobPattern.parse(
+                line, '{}:{}'.format(fp.name, lineno))))
         return class_(patterns)
 
     def dump(self):
-        print 'Patterns:'
+        print('Patterns:')
         for positive, pattern in self.patterns:
-            print '    {}{}'.format('' if positive else '!', str(pattern))
+            print('    {}{}'.format('' if positive else '!', str(pattern)))
 
     def match_path(self, path):
         """Test whether the pattern set matches a full path."""
@@ -237,4 +258,4 @@ if __name__ == '__main__':
         if p.match_path(path) != match:
             raise Exception(
                 'Expected match={} for path={}'.format(match, path))
-    print 'Test passed'
+    print('Test passed')
@@ -0,0 +1,162 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Progress reports for long runs."""
+import json
+import os
+import time
+
+def _format_size(size):
+    for unit in ('B', 'kB', 'MB'):
+        if size < 1000:
+            return '{:.0f} {}'.format(size, unit)
+        size /= 1000.0
+    return '{:.1f} GB'.format(size)
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{}:{:02}:{:02}'.format(
+            seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return '{}:{:02}'.format(seconds // 60, seconds % 60)
+
+class Progress(object):
+    """The progress of a run.
+
+    The total is an estimate of the number of paths the run scans,
+    or None.  If scanned is not None, it is a function which returns
+    the number of paths scanned so far, including files which are not
+    source files, otherwise only the source files are counted.  The
+    report is updated at most once per interval, in seconds, so
+    updating the progress for each file is cheap.
+    """
+    __slots__ = ['fp', 'total', 'scanned', 'interval', 'start', 'last',
+                 'files', 'changed', 'bytes', 'name']
+
+    def __init__(self, fp, total=None, interval=0.2, scanned=None):
+        self.fp = fp
+        self.total = total
+        self.scanned = scanned
+        self.interval = interval
+        self.start = time.time()
+        self.last = self.start
+        self.files = 0
+        self.changed = 0
+        self.bytes = 0
+        self.name = None
+
+    def update(self, name, size, changed):
+        """Count a file which was checked."""
+        self.files += 1
+        self.bytes += size
+        if changed:
+            self.changed += 1
+        self.name = name
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.show(self.stats(now), False)
+
+    def finish(self):
+        """Report the final results."""
+        self.show(self.stats(time.time()), True)
+
+    def clear(self):
+        """Remove the report before writing other output."""
+        pass
+
+    def stats(self, now):
+        elapsed = now - self.start
+        if self.scanned is not None:
+            scanned = self.scanned()
+        else:
+            scanned = self.files
+        if elapsed > 0:
+            files_per_second = self.files / elapsed
+            bytes_per_second = self.bytes / elapsed
+            scanned_per_second = scanned / elapsed
+        else:
+            files_per_second = 0.0
+            bytes_per_second = 0.0
+            scanned_per_second = 0.0
+        if self.total is not None and scanned_per_second > 0:
+            eta = max(self.total - scanned, 0) / scanned_per_second
+        else:
+            eta = None
+        return {
+            'elapsed': elapsed,
+            'scanned': scanned,
+            'files': self.files,
+            'total': self.total,
+            'changed': self.changed,
+            'bytes': self.bytes,
+            'files_per_second': files_per_second,
+            'bytes_per_second': bytes_per_second,
+            'eta': eta,
+            'directory': (os.path.dirname(self.name)
+                          if self.name is not None else None),
+        }
+
+    def show(self, stats, done):
+        raise NotImplementedError('Progress.show')
+
+class TextProgress(Progress):
+    """Report progress as a status line, for terminals."""
+    __slots__ = ['width', 'shown']
+
+    def __init__(self, fp, total=None, interval=0.2, scanned=None,
+                 width=79):
+        super(TextProgress, self).__init__(fp, total, interval, scanned)
+        self.width = width
+        self.shown = 0
+
+    def clear(self):
+        if self.shown:
+            self.fp.write('\r' + ' ' * self.shown + '\r')
+            self.fp.flush()
+            self.shown = 0
+
+    def show(self, stats, done):
+        if stats['total'] is not None:
+            scanned = '{}/~{} scanned'.format(stats['scanned'],
+                                              stats['total'])
+        else:
+            scanned = '{} scanned'.format(stats['scanned'])
+        fields = [
+            scanned,
+            '{} files'.format(stats['files']),
+            '{} changed'.format(stats['changed']),
+            '{:.0f} files/s'.format(stats['files_per_second']),
+            '{}/s'.format(_format_size(stats['bytes_per_second'])),
+        ]
+        if done:
+            fields.append('done in {}'.format(_format_time(stats['elapsed'])))
+        else:
+            if stats['eta'] is not None:
+                fields.append('ETA {}'.format(_format_time(stats['eta'])))
+            if stats['directory']:
+                fields.append(stats['directory'])
+        line = ', '.join(fields)[:self.width]
+        self.fp.write('\r' + line.ljust(self.shown))
+        self.shown = len(line)
+        if done:
+            self.fp.write('\n')
+            self.shown = 0
+        self.fp.flush()
+
+class JSONProgress(Progress):
+    """Report progress as JSON, with one object per line."""
+    __slots__ = []
+
+    def show(self, stats, done):
+        stats['done'] = done
+        json.dump(stats, self.fp, sort_keys=True)
+        self.fp.write('\n')
+        self.fp.flush()
+
+PROGRESS = {
+    'text': TextProgress,
+    'json': JSONProgress,
+}
@@ -0,0 +1,171 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Machine-readable reports of the results of a run."""
+import json
+from . import memory
+
+class Report(object):
+    """The results of a run, which can be saved as JSON.
+
+    Reports from runs over different shards of a repository can be
+    merged into a single report.  Paths are relative to the
+    repository root.  The memory use of the run is included if it was
+    measured, in the JSON form of memory.MemoryStats.
+    """
+    __slots__ = ['shards', 'files', 'changed', 'long_lines', 'memory']
+
+    def __init__(self, shards=()):
+        self.shards = list(shards)
+        self.files = 0
+        self.changed = []
+        self.long_lines = {}
+        self.memory = None
+
+    def add_file(self, path, changed, long_lines=(0, 0)):
+        """Add the results for one file.
+
+        The long lines are summarized as (count, max_width).
+        """
+        self.files += 1
+        if changed:
+            self.changed.append(path)
+        count, max_width = long_lines
+        if count:
+            self.long_lines[path] = {'count': count, 'max_width': max_width}
+
+    def to_json(self):
+        data = {
+            'shards': sorted(self.shards),
+            'files': self.files,
+            'changed': sorted(self.changed),
+            'long_lines': self.long_lines,
+        }
+        if self.memory is not None:
+            data['memory'] = self.memory
+        return data
+
+    def write(self, fp):
+        json.dump(self.to_json(), fp, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        fp.write('\n')
+
+    @classmethod
+    def read(class_, fp):
+        data = json.load(fp)
+        report = class_([tuple(shard) for shard in data['shards']])
+        report.files = data['files']
+        report.changed = list(data['changed'])
+        report.long_lines = dict(data['long_lines'])
+        report.memory = data.get('memory')
+        return report
+
+    @classmethod
+    def merge(class_, reports):
+        """Merge reports from different shards into one report.
+
+        Raises ValueError if the reports do not come from distinct
+        shards of the same run.
+        """
+        merged = class_()
+        for report in reports:
+            for shard in report.shards:
+                if shard in merged.shards:
+                    raise ValueError(
+                        'shard {}/{} appears twice'
+                        .format(shard[0] + 1, shard[1]))
+                if merged.shards and merged.shards[0][1] != shard[1]:
+                    raise ValueError('reports have different shard counts')
+                merged.shards.append(shard)
+            merged.files += report.files
+            merged.changed.extend(report.changed)
+            merged.long_lines.update(report.long_lines)
+        merged.memory = memory.merge_json(
+            report.memory for report in reports
+            if report.memory is not None)
+        return merged
+
+    def missing_shards(self):
+        """Get the shards which are not included in this report."""
+        if not self.shards:
+            return []
+        count = self.shards[0][1]
+        return [(index, count) for index in range(count)
+                if (index, count) not in self.shards]
+
+class LongLineSink(object):
+    """A streaming report of lines which are too long.
+
+    Lines are written as soon as they are found, and at most "limit"
+    lines are written for each file, or all lines if the limit is
+    zero.  Only the count and maximum width are kept for the rest, so
+    memory use does not depend on the number of long lines.
+    """
+    __slots__ = ['fp', 'limit']
+
+    def __init__(self, fp, limit=0):
+        self.fp = fp
+        self.limit = limit
+
+    def add(self, path, long_lines):
+        """Report the (lineno, width) long lines for a file.
+
+        Returns (count, max_width).
+        """
+        count = 0
+        max_width = 0
+        for lineno, width in long_lines:
+            count += 1
+            max_width = max(max_width, width)
+            if not self.limit or count <= self.limit:
+                self.write_line(path, count, lineno, width)
+        if count:
+            self.write_summary(path, count, max_width)
+            self.fp.flush()
+        return count, max_width
+
+    def write_line(self, path, count, lineno, width):
+        raise NotImplementedError('LongLineSink.write_line')
+
+    def write_summary(self, path, count, max_width):
+        raise NotImplementedError('LongLineSink.write_summary')
+
+class TextLongLineSink(LongLineSink):
+    """Report long lines as text."""
+    __slots__ = []
+
+    def write_line(self, path, count, lineno, width):
+        if count == 1:
+            self.fp.write('\n{}: Lines too long\n'.format(path))
+        self.fp.write('    {}: {} columns\n'.format(lineno, width))
+
+    def write_summary(self, path, count, max_width):
+        if self.limit and count > self.limit:
+            self.fp.write(
+                '    ... {} more, {} lines total, up to {} columns\n'
+                .format(count - self.limit, count, max_width))
+
+class JSONLongLineSink(LongLineSink):
+    """Report long lines as JSON, with one object per line.
+
+    Each long line is written as {"path", "line", "width"}, and each
+    file is followed by {"path", "count", "max_width"}.
+    """
+    __slots__ = []
+
+    def write_line(self, path, count, lineno, width):
+        json.dump({'path': path, 'line': lineno, 'width': width}, self.fp,
+                  sort_keys=True)
+        self.fp.write('\n')
+
+    def write_summary(self, path, count, max_width):
+        json.dump({'path': path, 'count': count, 'max_width': max_width},
+                  self.fp, sort_keys=True)
+        self.fp.write('\n')
+
+LONG_LINE_SINKS = {
+    'text': TextLongLineSink,
+    'json': JSONLongLineSink,
+}
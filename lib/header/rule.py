@@ -3,11 +3,13 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+from __future__ import print_function
 import os
 import re
 from . import environ
 from . import pattern
 from . import git
+from . import util
 
 DEFAULT_ENV = {
     'ignore': False,
@@ -43,7 +45,8 @@ class Lexer(object):
                 if len(fields) != 2:
                     self.error('expected one pattern')
                 return 'PATTERN', (fields[0] == '+',
-                                   pattern.GlobPattern.parse(fields[1]))
+                                   pattern.GlobPattern.parse(
+                                       fields[1], self.source()))
             if len(fields) >= 2 and fields[1] == '=':
                 if len(fields) == 3:
                     data = fields[2]
@@ -75,23 +78,48 @@ class Lexer(object):
                     self.error(ex)
             self.error('syntax error')
         raise StopIteration()
+    __next__ = next
+
+    def source(self):
+        return '{}:{}'.format(self.fp.name, self.lineno)
 
     def error(self, msg):
-        raise ValueError('{}:{}: {}'.format(self.fp.name, self.lineno, msg))
+        raise ValueError('{}: {}'.format(self.source(), msg))
 
 NON_TOKEN = re.compile('[^a-zA-Z0-9]+')
 def to_macro(x):
     return NON_TOKEN.subn('_', x)[0].upper().strip('_')
 
 class Rules(object):
-    __slots__ = ['env', 'rules']
+    """A set of rules for computing the environment of files.
+
+    The rules are stored as a tuple of segments, where each segment
+    is a tuple of (patternset, rules) pairs.  Segments are shared
+    between a directory's rules and its parent's rules whenever they
+    do not change, so descending into a directory only allocates
+    segments for rules which changed, and the rules from each
+    .gitignore or .header file are never copied.
+    """
+    __slots__ = ['env', 'segments']
 
-    def __init__(self, env, rules):
+    def __init__(self, env, rules=(), segments=None):
         self.env = dict(env)
-        self.rules = tuple(rules)
+        if segments is None:
+            rules = tuple(rules)
+            segments = (rules,) if rules else ()
+        self.segments = segments
 
     def __nonzero__(self):
-        return bool(self.env) or bool(self.rules)
+        return bool(self.env) or bool(self.segments)
+
+    __bool__ = __nonzero__
+
+    @property
+    def rules(self):
+        """The (patternset, rules) pairs, in order."""
+        if len(self.segments) == 1:
+            return self.segments[0]
+        return tuple(item for segment in self.segments for item in segment)
 
     def _base_env(self, fname):
         env = dict(DEFAULT_ENV)
@@ -110,9 +138,10 @@ class Rules(object):
     def file_env(self, fname):
         """Get the environment for a file, or None if the file is ignored."""
         env = self._base_env(fname)
-        for patternset, rule in self.rules:
-            if patternset.match_file(fname):
-                env.update(rule.env)
+        for segment in self.segments:
+            for patternset, rule in segment:
+                if patternset.match_file(fname):
+                    env.update(rule.env)
         if env['ignore']:
             return None
         return env
@@ -120,17 +149,37 @@ class Rules(object):
     def dir_rules(self, fname):
         """Get the rules for a directory, or None if it is ignored."""
         env = self._base_env(fname)
-        rules = []
-        for patternset, rule in self.rules:
-            match, patternset = patternset.match_dir(fname)
-            if patternset:
-                rules.append((patternset, rule))
-            if match:
-                env.update(rule.env)
-                rules.extend(rule.rules)
+        segments = []
+        changed = False
+        for segment in self.segments:
+            rules = None
+            for n, item in enumerate(segment):
+                patternset, rule = item
+                match, dir_patternset = patternset.match_dir(fname)
+                if match:
+                    env.update(rule.env)
+                if (dir_patternset is patternset and
+                    not (match and rule.segments)):
+                    if rules is not None:
+                        rules.append(item)
+                    continue
+                if rules is None:
+                    rules = list(segment[:n])
+                if dir_patternset:
+                    rules.append((dir_patternset, rule))
+                if match:
+                    rules.extend(rule.rules)
+            if rules is None:
+                segments.append(segment)
+            else:
+                changed = True
+                if rules:
+                    segments.append(tuple(rules))
         if env.get('ignore', False):
             return None
-        return Rules(env, rules)
+        if not changed:
+            return Rules(env, segments=self.segments)
+        return Rules(env, segments=tuple(segments))
 
     def union(self, other):
         """Compute the union of two sets of rules."""
@@ -140,7 +189,7 @@ class Rules(object):
             return other
         e = dict(self.env)
         e.update(other.env)
-        return Rules(e, self.rules + other.rules)
+        return Rules(e, segments=self.segments + other.segments)
 
     @classmethod
     def _read_group(class_, lex):
@@ -192,7 +241,7 @@ class Rules(object):
         if value is None:
             return None
         try:
-            fp = open(os.path.expanduser(value), 'r')
+            fp = util.open_text(os.path.expanduser(value))
         except IOError:
             return None
         with fp:
@@ -202,16 +251,16 @@ class Rules(object):
         istr = ' ' * indent
         if patternset is not None:
             for positive, pattern in patternset.patterns:
-                print '{}{} {}'.format(
-                    istr, '+' if positive else '-', pattern)
-        for k, v in sorted(self.env.iteritems()):
+                print('{}{} {}'.format(
+                    istr, '+' if positive else '-', pattern))
+        for k, v in sorted(self.env.items()):
             if k.startswith('_'):
                 continue
-            print '{}{}'.format(istr, environ.dump_var(k, v))
+            print('{}{}'.format(istr, environ.dump_var(k, v)))
         for patternset, rules in self.rules:
-            print '{}{{'.format(istr)
+            print('{}{{'.format(istr))
             rules._dump(indent + 4, patternset)
-            print '{}}}'.format(istr)
+            print('{}}}'.format(istr))
 
     def dump(self):
         self._dump(0, None)
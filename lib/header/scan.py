@@ -3,71 +3,345 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+import functools
 import os
 import stat
 from . import rule
-
-def scan_dir(rules, path, includes, excludes):
+from . import util
+try:
+    from os import scandir
+except ImportError:
     try:
-        fp = open(os.path.join(path, '.gitignore'))
-    except IOError:
-        pass
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def _read_rules(rules, gitignore, header):
+    """Add the rules from a directory's .gitignore and .header files.
+
+    The files are file objects, or None if they do not exist.
+    """
+    if gitignore is not None:
+        with gitignore:
+            rules = rules.union(rule.Rules.read_gitignore(gitignore))
+    if header is not None:
+        with header:
+            rules = rules.union(rule.Rules.read(header))
+    return rules
+
+def _file_env(rules, fname, includes, excludes):
+    """Get the environment for a file, or None if it is skipped."""
+    if includes is not None and not includes.match_file(fname):
+        return None
+    if excludes is not None and excludes.match_file(fname):
+        return None
+    return rules.file_env(fname)
+
+def _dir_rules(rules, fname, includes, excludes):
+    """Get (rules, includes, excludes) for a subdirectory.
+
+    Returns None if the subdirectory is skipped.
+    """
+    if includes is not None:
+        match, dir_includes = includes.match_dir(fname)
+        if match:
+            dir_includes = None
+        elif not dir_includes:
+            return None
     else:
-        with fp:
-            nrules = rule.Rules.read_gitignore(fp)
-        rules = rules.union(nrules)
+        dir_includes = None
+    if excludes is not None:
+        match, dir_excludes = excludes.match_dir(fname)
+        if match:
+            return None
+        elif not dir_excludes:
+            dir_excludes = None
+    else:
+        dir_excludes = None
+    drules = rules.dir_rules(fname)
+    if drules is None:
+        return None
+    return drules, dir_includes, dir_excludes
 
+def _open(path):
     try:
-        fp = open(os.path.join(path, '.header'))
+        return util.open_text(path)
     except IOError:
-        pass
-    else:
+        return None
+
+class ConfigCache(object):
+    """A cache of the rules in .gitignore and .header files.
+
+    Each file is parsed again only if its inode, size, or modification
+    time changes.
+    """
+    __slots__ = ['files']
+
+    def __init__(self):
+        self.files = {}
+
+    def _read(self, path, reader):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            return None
+        key = st.st_ino, st.st_size, st.st_mtime
+        try:
+            fkey, rules = self.files[path]
+        except KeyError:
+            pass
+        else:
+            if fkey == key:
+                return rules
+        fp = _open(path)
+        if fp is None:
+            return None
         with fp:
-            nrules = rule.Rules.read(fp)
-        rules = rules.union(nrules)
+            rules = reader(fp)
+        self.files[path] = key, rules
+        return rules
+
+    def load_files(self, path, names=None):
+        """Read a directory's configuration files.
+
+        Returns a list of (path, rules) for the files which exist.  If
+        names is not None, it contains the names of the files in the
+        directory, and missing configuration files are not opened.
+        """
+        result = []
+        for fname, reader in (('.gitignore', rule.Rules.read_gitignore),
+                              ('.header', rule.Rules.read)):
+            if names is not None and fname not in names:
+                continue
+            fpath = os.path.join(path, fname)
+            frules = self._read(fpath, reader)
+            if frules is not None:
+                result.append((fpath, frules))
+        return result
+
+    def load_dir(self, path, names=None):
+        """Read a directory's configuration files, returning the rules."""
+        return [frules for fpath, frules in self.load_files(path, names)]
+
+    def read_dir(self, rules, path, names=None):
+        """Add the rules from a directory's configuration files."""
+        for frules in self.load_dir(path, names):
+            rules = rules.union(frules)
+        return rules
+
+    def invalidate(self, path=None):
+        """Forget the cached rules for a file, or for all files."""
+        if path is None:
+            self.files.clear()
+        else:
+            self.files.pop(path, None)
 
-    fnames = os.listdir(path)
+def _list_dir(path):
+    """List a directory, returning (files, dirs, names).
+
+    Only regular files and directories are returned, and symbolic
+    links are not followed.  With scandir(), file types come from the
+    directory listing and entries are only stat'ed if the file system
+    does not report their types.
+    """
     files = []
     dirs = []
-    for fname in fnames:
-        st = os.lstat(os.path.join(path, fname))
-        if stat.S_ISREG(st.st_mode):
-            files.append(fname)
-        elif stat.S_ISDIR(st.st_mode):
-            dirs.append(fname)
-
-    for fname in files:
-        if includes is not None and not includes.match_file(fname):
+    names = set()
+    if scandir is not None:
+        for entry in scandir(path):
+            names.add(entry.name)
+            if entry.is_file(follow_symlinks=False):
+                files.append(entry.name)
+            elif entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+    else:
+        for fname in os.listdir(path):
+            names.add(fname)
+            st = os.lstat(os.path.join(path, fname))
+            if stat.S_ISREG(st.st_mode):
+                files.append(fname)
+            elif stat.S_ISDIR(st.st_mode):
+                dirs.append(fname)
+    return files, dirs, names
+
+def _load_dir(path, is_root, config):
+    """List a directory and read its configuration files.
+
+    Returns (files, dirs, configs), or None if the directory is not
+    the root and contains .git.
+    """
+    files, dirs, names = _list_dir(path)
+    if not is_root and '.git' in names:
+        return None
+    return files, dirs, config.load_dir(path, names)
+
+def scan_dir(rules, path, includes, excludes, config=None, pool=None):
+    """Scan a directory in the work tree.
+
+    Yields (path, env) for each file, depth first, with the files in
+    each directory before its subdirectories.  Subdirectories
+    containing .git are submodules or other repositories, and are
+    skipped.  If config is not None, it is a ConfigCache used to read
+    .gitignore and .header files.
+
+    If pool is not None, it is a thread pool which lists directories
+    and reads their configuration files ahead of time.  This helps on
+    network file systems, where each operation waits for the server.
+    The results are the same, and in the same order.
+    """
+    if config is None:
+        config = ConfigCache()
+    if pool is None:
+        load = lambda *args: functools.partial(_load_dir, *args)
+    else:
+        load = lambda *args: pool.apply_async(_load_dir, args).get
+    stack = [(load(path, True, config), path, rules, includes, excludes)]
+    while stack:
+        result, path, rules, includes, excludes = stack.pop()
+        value = result()
+        if value is None:
             continue
-        if excludes is not None and excludes.match_file(fname):
+        files, dirs, configs = value
+        for frules in configs:
+            rules = rules.union(frules)
+
+        for fname in files:
+            env = _file_env(rules, fname, includes, excludes)
+            if env is None:
+                continue
+            yield os.path.join(path, fname), env
+
+        subdirs = []
+        for fname in dirs:
+            value = _dir_rules(rules, fname, includes, excludes)
+            if value is None:
+                continue
+            drules, dir_includes, dir_excludes = value
+            fpath = os.path.join(path, fname)
+            subdirs.append((load(fpath, False, config), fpath, drules,
+                            dir_includes, dir_excludes))
+        subdirs.reverse()
+        stack.extend(subdirs)
+
+def _descend(rules, root, parts, includes, excludes, config):
+    """Get the rules for the directory containing a path.
+
+    Only the configuration files in the directories from the root to
+    the path are read.  Returns (path, rules, includes, excludes) for
+    the directory, or None if it would be skipped by scan_dir().
+    """
+    path = root
+    rules = config.read_dir(rules, path)
+    for fname in parts[:-1]:
+        value = _dir_rules(rules, fname, includes, excludes)
+        if value is None:
+            return None
+        rules, includes, excludes = value
+        path = os.path.join(path, fname)
+        if os.path.exists(os.path.join(path, '.git')):
+            return None
+        rules = config.read_dir(rules, path)
+    return path, rules, includes, excludes
+
+def path_env(rules, root, parts, excludes, config):
+    """Get the environment for one file in the work tree.
+
+    The file is given as a list of path components relative to the
+    root.  Returns None if the file would be skipped by scan_dir().
+    """
+    value = _descend(rules, root, parts, None, excludes, config)
+    if value is None:
+        return None
+    path, rules, includes, excludes = value
+    return _file_env(rules, parts[-1], includes, excludes)
+
+def scan_path(rules, root, parts, includes, excludes, config=None,
+              pool=None):
+    """Scan a file or directory in the work tree.
+
+    The path is given as a list of path components relative to the
+    root.  This yields the same results as the part of scan_dir() for
+    the root which is inside the path, but only reads the directories
+    on the way to the path.  Nothing is yielded if the path does not
+    exist.  The pool is passed to scan_dir().
+    """
+    if config is None:
+        config = ConfigCache()
+    value = _descend(rules, root, parts, includes, excludes, config)
+    if value is None:
+        return
+    path, rules, includes, excludes = value
+    fname = parts[-1]
+    fpath = os.path.join(path, fname)
+    try:
+        st = os.lstat(fpath)
+    except OSError:
+        return
+    if stat.S_ISREG(st.st_mode):
+        env = _file_env(rules, fname, includes, excludes)
+        if env is not None:
+            yield fpath, env
+    elif stat.S_ISDIR(st.st_mode):
+        value = _dir_rules(rules, fname, includes, excludes)
+        if value is None:
+            return
+        rules, includes, excludes = value
+        if os.path.exists(os.path.join(fpath, '.git')):
+            return
+        for result in scan_dir(rules, fpath, includes, excludes, config,
+                               pool):
+            yield result
+
+def _index_tree(entries):
+    """Convert a list of index entries into a tree of dictionaries."""
+    tree = {}
+    for entry in entries:
+        parts = entry[-1].split('/')
+        node = tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = entry
+    return tree
+
+def _scan_tree(rules, prefix, tree, includes, excludes, read):
+    def config(name):
+        entry = tree.get(name)
+        if entry is None or isinstance(entry, dict):
+            return None
+        return util.text_file(read(entry), prefix + name)
+    rules = _read_rules(rules, config('.gitignore'), config('.header'))
+
+    fnames = sorted(tree)
+    for fname in fnames:
+        entry = tree[fname]
+        if isinstance(entry, dict):
             continue
-        env = rules.file_env(fname)
+        env = _file_env(rules, fname, includes, excludes)
         if env is None:
             continue
-        yield os.path.join(path, fname), env
-
-    for fname in dirs:
-        if includes is not None:
-            match, dir_includes = includes.match_dir(fname)
-            if match:
-                dir_includes = None
-            elif not dir_includes:
-                continue
-        else:
-            dir_includes = None
-        if excludes is not None:
-            match, dir_excludes = excludes.match_dir(fname)
-            if match:
-                continue
-            elif not dir_excludes:
-                dir_excludes = None
-        else:
-            dir_excludes = None
-        drules = rules.dir_rules(fname)
-        if drules is None:
+        yield entry, env
+
+    for fname in fnames:
+        entry = tree[fname]
+        if not isinstance(entry, dict):
             continue
-        fpath = os.path.join(path, fname)
-        if os.path.exists(os.path.join(fpath, '.git')):
+        value = _dir_rules(rules, fname, includes, excludes)
+        if value is None:
             continue
-        for result in scan_dir(drules, fpath, dir_includes, dir_excludes):
+        drules, dir_includes, dir_excludes = value
+        for result in _scan_tree(drules, prefix + fname + '/', entry,
+                                 dir_includes, dir_excludes, read):
             yield result
+
+def scan_index(rules, entries, includes, excludes, read):
+    """Scan the files staged in the index.
+
+    The entries are tuples whose last element is the path relative to
+    the repository root, as returned by git.ls_files().  The read
+    function returns the contents of an entry, and is used to read
+    .gitignore and .header files from the index rather than the work
+    tree.  Yields (entry, env) for each file.
+    """
+    return _scan_tree(rules, '', _index_tree(entries),
+                      includes, excludes, read)
@@ -0,0 +1,164 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""JSON-RPC server for editors and other tools.
+
+Requests and responses are JSON-RPC 2.0 objects, one per line, read
+from standard input and written to standard output.  Configuration
+stays loaded between requests.  The methods are:
+
+check(path, contents=None): Check a file, returning {"path", "source",
+    "filetype", "changed", "diff", "long_lines"}.  If the file is not a
+    source file or is ignored, "source" is false and nothing else is
+    returned.
+
+fix(path, contents=None): Fix a file, returning {"path", "source",
+    "changed", "contents"}.  The file itself is not modified.
+
+invalidate(path=None): Forget the cached contents of a configuration
+    file, or of all configuration.
+
+If contents is given, it is used instead of the file on disk, for
+example, an unsaved editor buffer.  Contents are UTF-8.
+"""
+import json
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+FAILED = -32000
+
+class RPCError(Exception):
+    """An error which is reported to the client."""
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+def _decode(data):
+    try:
+        return data.decode('UTF-8')
+    except UnicodeDecodeError:
+        raise RPCError(FAILED, 'file is not UTF-8')
+
+class Server(object):
+    """A server which processes files with the given options."""
+    __slots__ = ['session', 'options']
+
+    METHODS = {
+        'check': ('path', 'contents'),
+        'fix': ('path', 'contents'),
+        'invalidate': ('path',),
+    }
+
+    def __init__(self, session, options):
+        self.session = session
+        self.options = options
+
+    def _process(self, path, contents):
+        if contents is not None:
+            contents = contents.encode('UTF-8')
+        return self.session.process_file(path, contents, self.options)
+
+    def check(self, path, contents=None):
+        result = self._process(path, contents)
+        if result is None:
+            return {'path': path, 'source': False}
+        changed = result.changed
+        return {
+            'path': path,
+            'source': True,
+            'filetype': result.filetype.name,
+            'changed': changed,
+            'diff': _decode(result.diff()) if changed else None,
+            'long_lines': [list(line) for line in result.long_lines()],
+        }
+
+    def fix(self, path, contents=None):
+        result = self._process(path, contents)
+        if result is None:
+            return {'path': path, 'source': False}
+        return {
+            'path': path,
+            'source': True,
+            'changed': result.changed,
+            'contents': _decode(result.contents),
+        }
+
+    def invalidate(self, path=None):
+        self.session.invalidate(path)
+        return None
+
+    def call(self, method, params):
+        """Call a method, raising RPCError on failure."""
+        try:
+            names = self.METHODS[method]
+        except (KeyError, TypeError):
+            raise RPCError(METHOD_NOT_FOUND,
+                           'unknown method: {}'.format(method))
+        if params is None:
+            params = {}
+        elif isinstance(params, list):
+            if len(params) > len(names):
+                raise RPCError(INVALID_PARAMS, 'too many parameters')
+            params = dict(zip(names, params))
+        elif not isinstance(params, dict):
+            raise RPCError(INVALID_PARAMS, 'invalid parameters')
+        for name, value in params.items():
+            if name not in names:
+                raise RPCError(INVALID_PARAMS,
+                               'unknown parameter: {}'.format(name))
+            if value is not None and not isinstance(value, basestring):
+                raise RPCError(INVALID_PARAMS,
+                               'parameter is not a string: {}'.format(name))
+        if 'path' not in params and method != 'invalidate':
+            raise RPCError(INVALID_PARAMS, 'missing parameter: path')
+        params = dict((str(name), value) for name, value in params.items())
+        try:
+            return getattr(self, method)(**params)
+        except (ValueError, IOError, OSError) as ex:
+            raise RPCError(FAILED, str(ex))
+
+    def handle(self, line):
+        """Handle one request, returning the response or None."""
+        try:
+            request = json.loads(line)
+        except ValueError as ex:
+            return {'jsonrpc': '2.0', 'id': None,
+                    'error': {'code': PARSE_ERROR, 'message': str(ex)}}
+        if not isinstance(request, dict) or 'method' not in request:
+            return {'jsonrpc': '2.0', 'id': None,
+                    'error': {'code': INVALID_REQUEST,
+                              'message': 'invalid request'}}
+        try:
+            result = self.call(request['method'], request.get('params'))
+        except RPCError as ex:
+            response = {'error': {'code': ex.code, 'message': str(ex)}}
+        else:
+            response = {'result': result}
+        if 'id' not in request:
+            return None
+        response['jsonrpc'] = '2.0'
+        response['id'] = request['id']
+        return response
+
+    def serve(self, infp, outfp):
+        """Handle requests until the end of the input."""
+        try:
+            for line in iter(infp.readline, ''):
+                if not line.strip():
+                    continue
+                response = self.handle(line)
+                if response is not None:
+                    json.dump(response, outfp, sort_keys=True)
+                    outfp.write('\n')
+                    outfp.flush()
+        finally:
+            self.session.close()
@@ -0,0 +1,164 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Splitting a run into shards.
+
+Shards are selected by objects which are used like the include
+pattern set when scanning: match_file(name) tests whether a file in
+the current directory is included, and match_dir(name) returns
+(match, subset) for a subdirectory, where an empty subset means that
+the subdirectory can be skipped.
+"""
+import heapq
+import zlib
+from . import git
+from . import util
+
+def parse_shard(string):
+    """Parse a shard specification of the form "i/N".
+
+    Shards are numbered starting from 1.  Returns (index, count),
+    where the index starts from 0.
+    """
+    try:
+        index, count = string.split('/')
+        index = int(index)
+        count = int(count)
+    except ValueError:
+        raise ValueError('invalid shard: {!r}'.format(string))
+    if not (1 <= index <= count):
+        raise ValueError('shard out of range: {!r}'.format(string))
+    return index - 1, count
+
+def path_hash(path):
+    """Get a stable hash of a path relative to the repository root."""
+    return zlib.crc32(util.encode(path)) & 0xffffffff
+
+class HashShard(object):
+    """Select files by a stable hash of their path."""
+    __slots__ = ['index', 'count', 'prefix']
+
+    def __init__(self, index, count, prefix=''):
+        self.index = index
+        self.count = count
+        self.prefix = prefix
+
+    def __nonzero__(self):
+        return True
+
+    __bool__ = __nonzero__
+
+    def match_file(self, name):
+        return path_hash(self.prefix + name) % self.count == self.index
+
+    def match_dir(self, name):
+        return False, HashShard(
+            self.index, self.count, self.prefix + name + '/')
+
+class PathSet(object):
+    """Select an explicit set of files.
+
+    Directories which contain no selected files are skipped.
+    """
+    __slots__ = ['tree']
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __nonzero__(self):
+        return bool(self.tree)
+
+    __bool__ = __nonzero__
+
+    def match_file(self, name):
+        return self.tree.get(name) is True
+
+    def match_dir(self, name):
+        subtree = self.tree.get(name)
+        if not isinstance(subtree, dict):
+            subtree = {}
+        return False, PathSet(subtree)
+
+    @classmethod
+    def from_paths(class_, paths):
+        """Create a path set from paths relative to the root."""
+        tree = {}
+        for path in paths:
+            parts = path.split('/')
+            node = tree
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = True
+        return class_(tree)
+
+class Intersection(object):
+    """Select files selected by both of two sets."""
+    __slots__ = ['first', 'second']
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def __nonzero__(self):
+        return bool(self.first) and bool(self.second)
+
+    __bool__ = __nonzero__
+
+    def match_file(self, name):
+        return (self.first.match_file(name) and
+                self.second.match_file(name))
+
+    def match_dir(self, name):
+        match1, sub1 = self.first.match_dir(name)
+        match2, sub2 = self.second.match_dir(name)
+        if match1:
+            return match2, sub2
+        if match2:
+            return match1, sub1
+        return False, Intersection(sub1, sub2)
+
+def intersect(includes, shard):
+    """Restrict a set of includes, which may be None, to a shard."""
+    if includes is None:
+        return shard
+    return Intersection(includes, shard)
+
+def balance_sizes(entries, index, count):
+    """Assign files to shards so each shard has a similar total size.
+
+    The entries are (path, size) pairs.  Files are assigned largest
+    first to the shard with the smallest total, which is deterministic
+    for a given set of entries.  Returns the paths in the given shard.
+    """
+    heap = [(0, n) for n in range(count)]
+    paths = []
+    entries = sorted(entries, key=lambda entry: (-entry[1], entry[0]))
+    for path, size in entries:
+        total, shard = heapq.heappop(heap)
+        heapq.heappush(heap, (total + size, shard))
+        if shard == index:
+            paths.append(path)
+    return paths
+
+def hash_shard(root, index, count):
+    """Select files in a shard by the hash of their path."""
+    return HashShard(index, count)
+
+def size_shard(root, index, count):
+    """Select files in a shard by balancing the size of files in the index.
+
+    Only files in the index are selected, and directories containing
+    no selected files are skipped without being scanned.
+    """
+    entries = git.ls_files(root)
+    sizes = git.object_sizes(root, [sha for mode, sha, path in entries])
+    paths = balance_sizes(
+        [(path, sizes[sha]) for mode, sha, path in entries], index, count)
+    return PathSet.from_paths(paths)
+
+SHARD_METHODS = {
+    'hash': hash_shard,
+    'size': size_shard,
+}
@@ -3,32 +3,204 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+import re
 import subprocess
+import tempfile
 from . import comment
 from . import copyright
+from . import throttle
+from . import util
 
 class ExternC(object):
-    head = ['#ifdef __cplusplus\n',
-            'extern "C" {\n',
-            '#endif\n']
-    tail = ['#ifdef __cplusplus\n',
-            '}\n',
-            '#endif\n']
+    head = [b'#ifdef __cplusplus',
+            b'extern "C" {',
+            b'#endif']
+    tail = [b'#ifdef __cplusplus',
+            b'}',
+            b'#endif']
+
+def split_lines(data):
+    """Split text into lines, keeping the line breaks."""
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+TRAILING_SPACE = re.compile(br'[ \t\r\x0b\x0c]+(?=\n|\Z)')
+BLANK_LINES = re.compile(br'\n\n\n+')
+UNCLEAN = (b' \n', b'\t\n', b'\r\n', b'\x0b\n', b'\x0c\n', b'\n\n\n')
+
+def is_clean(data):
+    """Test whether fix_whitespace() would leave LF text unchanged."""
+    if not data:
+        return True
+    if (not data.endswith(b'\n') or
+        data.startswith(b'\n') or
+        data.endswith(b'\n\n')):
+        return False
+    for unclean in UNCLEAN:
+        if unclean in data:
+            return False
+    return True
+
+def fix_whitespace(data, newline=b'\n'):
+    """Fix whitespace in text.
+
+    Removes trailing whitespace, leading and trailing blank lines, and
+    repeated blank lines, and ensures that non-empty text ends with a
+    line break.  All line breaks are replaced with the given line
+    break.  This is equivalent to stripping each line and joining the
+    non-blank lines, but works on the entire text at once.
+    """
+    if newline == b'\n' and is_clean(data):
+        return data
+    data = TRAILING_SPACE.sub(b'', data)
+    data = BLANK_LINES.sub(b'\n\n', data)
+    data = data.strip(b'\n')
+    if data:
+        data += b'\n'
+    if newline != b'\n':
+        data = data.replace(b'\n', newline)
+    return data
+
+URL_SCHEMES = (b'http://', b'https://', b'ftp://')
+
+# Compiled searches for lines which are too long, by width.
+_LONG_LINE_SEARCH = {}
+
+def _long_line_search(width):
+    try:
+        return _LONG_LINE_SEARCH[width]
+    except KeyError:
+        pass
+    # The pattern starts with a line break, so the search skips from
+    # one line break to the next without trying other positions.
+    search = re.compile(br'\n[^\n]{%d}' % (width + 1)).search
+    _LONG_LINE_SEARCH[width] = search
+    return search
+
+def find_long_lines(data, width):
+    """Enumerate (lineno, width) for lines in text which are too long.
+
+    Line breaks do not count toward the width, and lines containing
+    URLs are exempt.  Long lines are found with a regular expression
+    on the whole text, so no object is created for lines which fit.
+    """
+    if width <= 0 or len(data) <= width:
+        return
+    search = _long_line_search(width)
+    lineno = 1
+    pos = 0
+    end = data.find(b'\n')
+    if end < 0:
+        end = len(data)
+    # The search only finds lines after a line break, so the first
+    # line is checked separately.
+    start = 0 if end > width else None
+    while True:
+        if start is None:
+            match = search(data, end)
+            if match is None:
+                return
+            start = match.start() + 1
+            lineno += data.count(b'\n', pos, start)
+            pos = start
+            end = data.find(b'\n', match.end())
+            if end < 0:
+                end = len(data)
+        line = data[start:end].rstrip(b'\r')
+        if len(line) > width:
+            for scheme in URL_SCHEMES:
+                if scheme in line:
+                    break
+            else:
+                yield lineno, len(line)
+        start = None
+
+def detect_newline(data):
+    """Get the line break used by text, CRLF or LF."""
+    pos = data.find(b'\n')
+    if pos > 0 and data[pos-1:pos] == b'\r':
+        return b'\r\n'
+    return b'\n'
+
+def run_diff(args, text):
+    """Run diff with the given arguments and text as standard input.
+
+    Raises OSError if diff fails, for example, if a file is missing.
+    """
+    with throttle.subprocess_slot():
+        proc = subprocess.Popen(
+            ['diff', '-u'] + args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        stdout, stderr = proc.communicate(text)
+    if proc.returncode == 0:
+        return None
+    elif proc.returncode == 1:
+        return stdout
+    raise OSError('diff returned {}'.format(proc.returncode))
+
+def diff_contents(orig, text, label_orig, label_text):
+    """Get the difference between two texts which are not files."""
+    if text == orig:
+        return None
+    with tempfile.NamedTemporaryFile(prefix='headerfix') as fp:
+        fp.write(orig)
+        fp.flush()
+        return run_diff(
+            ['--label', label_orig, '--label', label_text,
+             '--', fp.name, '-'], text)
 
 class SourceFile(object):
-    __slots__ = ['path', 'relpath', 'env', 'filetype', 'lines',
-                 'addspace_start', 'addspace_end']
+    """A source file being fixed.
+
+    The contents are processed as bytes and are never decoded, so
+    files in any ASCII-compatible encoding are preserved.  Lines keep
+    their original line breaks, and new lines use the line break
+    found at the end of the file's first line.
+    """
+    __slots__ = ['path', 'relpath', 'env', 'filetype', '_lines', '_data',
+                 'orig', 'newline', 'addspace_start', 'addspace_end']
 
-    def __init__(self, path, relpath, env, filetype):
+    def __init__(self, path, relpath, env, filetype, data=None):
+        """Create a source file.
+
+        If data is None, the contents are read from the path.
+        """
         self.path = path
         self.relpath = relpath
         self.env = env
         self.filetype = filetype
-        with open(path, 'r') as fp:
-            self.lines = fp.readlines()
+        if data is None:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        self.orig = data
+        self.newline = detect_newline(data)
+        self._lines = None
+        self._data = data
         self.addspace_start = True
         self.addspace_end = True
 
+    @property
+    def lines(self):
+        """The new text, as a list of lines.
+
+        The text is stored either as a list of lines or as a single
+        string, and is converted when the other form is needed.
+        """
+        if self._lines is None:
+            self._lines = split_lines(self._data)
+            self._data = None
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = lines
+        self._data = None
+
     def run_filters(self):
         objs = []
         for filter in self.filters():
@@ -40,29 +212,44 @@ class SourceFile(object):
         for filter2, obj in objs:
             filter2(obj)
 
+    def fix(self, whitespace=False):
+        """Run the filters, and optionally fix whitespace and tabs."""
+        self.run_filters()
+        if whitespace:
+            self.end_lines()
+            self.expand_tabs()
+            self.fix_whitespace()
+
+    def end_lines(self):
+        """Add a line break to any line in the list which lacks one.
+
+        Only the last line of a file can lack a line break, but the
+        filters can add lines after it.  Whitespace is fixed on the
+        whole text at once, which would join such a line with the
+        next, so it must be ended first.
+        """
+        lines = self._lines
+        if lines is None or all(line.endswith(b'\n') for line in lines[:-1]):
+            return
+        self._lines = [line if line.endswith(b'\n') else line + b'\n'
+                       for line in lines]
+
     def fix_whitespace(self):
         """Fix minor whitespace issues.
 
         Removes extra blank lines, trailing whitespace, and ensures
-        that there is a line break at the end of the file.
+        that there is a line break at the end of the file.  Returns
+        True if anything changed.
         """
-        lines = []
-        blank = False
-        for line in self.lines:
-            line = line.rstrip()
-            if line:
-                if blank and lines:
-                    lines.append('\n')
-                lines.append(line + '\n')
-                blank = False
-            else:
-                blank = True
-        self.lines = lines
+        return self.set_contents(
+            fix_whitespace(self.contents(), self.newline))
 
     def expand_tabs(self):
-        """Convert tabs to spaces."""
-        width = self.env['tabsize']
-        self.lines = [line.expandtabs(width) for line in self.lines]
+        """Convert tabs to spaces.  Returns True if anything changed."""
+        data = self.contents()
+        if b'\t' not in data:
+            return False
+        return self.set_contents(data.expandtabs(self.env['tabsize']))
 
     def filters(self):
         yield 'shebang'
@@ -74,42 +261,43 @@ class SourceFile(object):
             yield 'externc'
 
     def write(self, fp):
-        for line in self.lines:
-            fp.write(line)
+        fp.write(self.contents())
 
     def save(self):
-        with open(self.path, 'w') as fp:
+        with open(self.path, 'wb') as fp:
             self.write(fp)
 
+    def contents(self):
+        """Get the new text."""
+        if self._data is None:
+            self._data = b''.join(self._lines)
+            self._lines = None
+        return self._data
+
+    def set_contents(self, data):
+        """Set the new text.  Returns True if it changed."""
+        if data == self.contents():
+            return False
+        self._data = data
+        return True
+
+    def changed(self):
+        """Test whether the new text differs from the original."""
+        return self.contents() != self.orig
+
     def diff(self):
         """Get the difference between the new text and the original.
 
         Returns None if there is no difference.
         """
-        proc = subprocess.Popen(
-            ['diff', '-u', '--', self.path, '-'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate(''.join(self.lines))
-        if proc.returncode == 0:
+        text = self.contents()
+        if text == self.orig:
             return None
-        elif proc.returncode == 1:
-            return stdout
-        raise Exception('diff returned {}'.format(proc.returncode))
+        return run_diff(['--', self.path, '-'], text)
 
     def long_lines(self):
         """Enumerate (lineno,width) lines that are too long."""
-        width = self.env['width']
-        if width <= 0:
-            return
-        for lineno, line in enumerate(self.lines, 1):
-            line = line.rstrip('\n')
-            if len(line) > width:
-                for exception in ('http://', 'https://', 'ftp://'):
-                    if exception in line:
-                        break
-                else:
-                    yield lineno, len(line)
+        return find_long_lines(self.contents(), self.env['width'])
 
     def wrap(self, head, tail, addspace_start, addspace_end):
         """Concatenate head and tail onto the beginning and end.
@@ -125,22 +313,22 @@ class SourceFile(object):
             not any(line.strip() for line in self.lines) and
             (self.addspace_start or self.addspace_end) and
             head and tail):
-            self.lines = ['\n'] * 2
+            self.lines = [self.newline] * 2
         if head:
             if (self.addspace_start and
                 self.lines and self.lines[0].strip()):
-                head.append('\n')
+                head.append(self.newline)
             self.addspace_start = addspace_start
         if tail:
             if (self.addspace_end and
                 self.lines and self.lines[-1].strip()):
-                tail.insert(0, '\n')
+                tail.insert(0, self.newline)
             self.addspace_end = addspace_end
         if head or tail:
             self.lines = head + self.lines + tail
 
     def shebang_filter1(self):
-        if not self.lines or not self.lines[0].startswith('#!'):
+        if not self.lines or not self.lines[0].startswith(b'#!'):
             return None
         self.addspace_start = False
         return self.lines.pop(0)
@@ -154,9 +342,9 @@ class SourceFile(object):
         pre, body, post = comment.remove_blank_lines(body)
         if len(body) < 3:
             return None
-        if (not body[0].startswith('#ifndef') or
-            not body[1].startswith('#define') or
-            not body[-1].startswith('#endif')):
+        if (not body[0].startswith(b'#ifndef') or
+            not body[1].startswith(b'#define') or
+            not body[-1].startswith(b'#endif')):
             return None
         self.lines = body[2:-1]
         self.addspace_start = False
@@ -166,17 +354,17 @@ class SourceFile(object):
     def headerguard_filter2(self, comments):
         head = list(comments or ())
         tail = []
-        guardname = self.env['guardname']
+        guardname = util.encode(self.env['guardname'])
         if self.env['guards'] and guardname:
-            head.extend(['#ifndef {}\n'.format(guardname),
-                         '#define {}\n'.format(guardname)])
-            tail.append('#endif\n')
+            head.extend([b'#ifndef ' + guardname + self.newline,
+                         b'#define ' + guardname + self.newline])
+            tail.append(b'#endif' + self.newline)
         self.wrap(head, tail, bool(comments), False)
 
     def copyright_filter1(self):
         head, body = comment.extract_lead_comment(self.lines, self.filetype)
         for pre, lbody, post in head:
-            if 'COPYRIGHT' in lbody.upper():
+            if b'COPYRIGHT' in lbody.upper():
                 break
         else:
             return None
@@ -193,13 +381,15 @@ class SourceFile(object):
             return
         authorship = copyright.Authorship()
         if val is not None:
-            authorship.parse([line for pre, line, post in val])
+            authorship.parse([util.decode(line) for pre, line, post in val])
         self.env['_authorship'].add_authorship(authorship)
-        lines = authorship.dump()
+        lines = [util.encode(line) for line in authorship.dump()]
         if self.env['copyright_notice']:
-            for line in self.env['copyright_notice'].splitlines():
-                lines.append(line + '\n')
-        lines = comment.comment(lines, self.filetype, self.env['width'])
+            notice = util.encode(self.env['copyright_notice'])
+            for line in notice.splitlines():
+                lines.append(line + b'\n')
+        lines = comment.comment(lines, self.filetype, self.env['width'],
+                                self.newline)
         if (self.filetype.blockcomment is None and
             self.lines and
             self.lines[0].strip().startswith(self.filetype.linecomment)):
@@ -209,15 +399,17 @@ class SourceFile(object):
         self.wrap(lines, None, False, False)
 
     def externc_filter1(self):
+        head = [line + self.newline for line in ExternC.head]
+        tail = [line + self.newline for line in ExternC.tail]
         startpos = -1
         endpos = -1
         for n, line in enumerate(self.lines):
-            if line != '#ifdef __cplusplus\n':
+            if line != head[0]:
                 continue
             lines = self.lines[n:n+3]
-            if lines == ExternC.head:
+            if lines == head:
                 startpos = n
-            elif lines == ExternC.tail:
+            elif lines == tail:
                 endpos = n
         if startpos >= 0 and endpos >= 0:
             preamble = self.lines[:startpos]
@@ -233,5 +425,126 @@ class SourceFile(object):
 
     def externc_filter2(self, value):
         preamble, postamble = value
-        self.wrap(ExternC.head, ExternC.tail, False, False)
+        self.wrap([line + self.newline for line in ExternC.head],
+                  [line + self.newline for line in ExternC.tail],
+                  False, False)
         self.wrap(preamble, postamble, False, False)
+
+class BufferFile(SourceFile):
+    """A source file whose contents were given instead of read.
+
+    The contents may be an unsaved editor buffer, and the file need
+    not exist, so changes are shown against the given contents.
+    """
+    __slots__ = []
+
+    def diff(self):
+        return diff_contents(self.orig, self.contents(),
+                             self.path + ' (buffer)', self.path)
+
+class IndexFile(SourceFile):
+    """A source file whose contents are staged in the index.
+
+    Changes are staged with an IndexWriter instead of being written to
+    the work tree.
+    """
+    __slots__ = ['name', 'mode', 'writer']
+
+    def __init__(self, path, relpath, env, filetype, data,
+                 name, mode, writer):
+        super(IndexFile, self).__init__(path, relpath, env, filetype, data)
+        self.name = name
+        self.mode = mode
+        self.writer = writer
+
+    def save(self):
+        self.writer.write(self.mode, self.name, self.contents())
+
+    def diff(self):
+        return diff_contents(self.orig, self.contents(),
+                             self.name + ' (staged)', self.name)
+
+class ArchiveFile(SourceFile):
+    """A source file which is a member of an archive.
+
+    Saving the file marks its changes to be written to the output
+    archive.
+    """
+    __slots__ = ['name', 'saved']
+
+    def __init__(self, env, filetype, data, name):
+        super(ArchiveFile, self).__init__(name, name, env, filetype, data)
+        self.name = name
+        self.saved = False
+
+    def save(self):
+        self.saved = True
+
+    def diff(self):
+        return diff_contents(self.orig, self.contents(),
+                             self.name + ' (archive)', self.name)
+
+class BlobFile(ArchiveFile):
+    """A source file which is a blob in a history stream."""
+    __slots__ = []
+
+    def diff(self):
+        return diff_contents(self.orig, self.contents(),
+                             self.name + ' (original)', self.name)
+
+if __name__ == '__main__':
+    import sys
+    from . import filetype
+    from . import rule
+    from . import year
+
+    def old_fix(src):
+        """Fix whitespace and tabs one line at a time."""
+        width = src.env['tabsize']
+        lines = []
+        blank = False
+        for line in src.lines:
+            line = line.expandtabs(width).rstrip()
+            if line:
+                if blank and lines:
+                    lines.append(src.newline)
+                lines.append(line + src.newline)
+                blank = False
+            else:
+                blank = True
+        return b''.join(lines)
+
+    def test(name, data, **env):
+        env = dict(rule.DEFAULT_ENV, _authorship=authorship, **env)
+        ftype = filetype.get_filetype(name)
+        src = ArchiveFile(dict(env), ftype, data, name)
+        src.run_filters()
+        expected = old_fix(src)
+        src = ArchiveFile(dict(env), ftype, data, name)
+        src.fix(True)
+        if src.contents() != expected:
+            sys.stderr.write(
+                'error: {}: {!r}\n'
+                '  expected {!r}\n'
+                '  got      {!r}\n'
+                .format(name, data, expected, src.contents()))
+            sys.exit(1)
+
+    authorship = copyright.AutoAuthorship(
+        None, 'Example Corp', year.YearRanges([(2013, 2013)]), False)
+    guards = dict(guards=True, guardname='P')
+    bodies = [
+        b'', b'\n', b'int x;', b'int x;\n', b'int x;  \t', b'int x;\f',
+        b'int x;\n\f', b'int x;\n\n\n\t', b'\tint x;\n\tint y;\r',
+        b'int x;\r\n\r\nint y;', b'\n\n  int x;\n\n', b'a\tb\rc\td',
+        b'#ifndef Q\n#define Q\nint x;\n#endif', b'/* c */\nint x;',
+        b'/* c */\nint x;\n\n', b'/* Copyright 2001 X. */\nint x;',
+        b'#ifdef __cplusplus\nextern "C" {\n#endif\n'
+        b'int x;\n#ifdef __cplusplus\n}\n#endif',
+    ]
+    for body in bodies:
+        for name, env in [('a.c', {}), ('a.h', {}), ('a.h', guards),
+                          ('a.h', dict(guards, extern_c=True))]:
+            test(name, body, **env)
+            test(name, b'#!/bin/sh\n' + body, **env)
+    print('Test passed')
@@ -0,0 +1,103 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Counters for finding expensive patterns.
+
+Counting is only done while a PatternStats object is installed, which
+replaces the matching methods of PathPattern with counting versions,
+so patterns cost nothing extra the rest of the time.
+"""
+import time
+from . import pattern
+
+class Counter(object):
+    """Counters for the patterns on one line of a file."""
+    __slots__ = ['source', 'text', 'evaluations', 'matches', 'seconds']
+
+    def __init__(self, source, text):
+        self.source = source
+        self.text = text
+        self.evaluations = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+class PatternStats(object):
+    """Counts evaluations, matches, and time for each pattern.
+
+    Patterns are counted by source, so the patterns which a pattern
+    creates for subdirectories are counted with the original pattern.
+    """
+    __slots__ = ['counters', 'saved']
+
+    def __init__(self):
+        self.counters = {}
+        self.saved = None
+
+    def _counter(self, pat):
+        source = pat.source or '(unknown)'
+        try:
+            return self.counters[source]
+        except KeyError:
+            counter = Counter(source, str(pat))
+            self.counters[source] = counter
+            return counter
+
+    def install(self):
+        """Start counting pattern matches."""
+        if self.saved is not None:
+            return
+        cls = pattern.PathPattern
+        match_file = cls.__dict__['match_file']
+        match_dir = cls.__dict__['match_dir']
+        self.saved = match_file, match_dir
+        stats = self
+
+        def counted_match_file(self, name):
+            start = time.time()
+            result = match_file(self, name)
+            counter = stats._counter(self)
+            counter.seconds += time.time() - start
+            counter.evaluations += 1
+            if result:
+                counter.matches += 1
+            return result
+
+        def counted_match_dir(self, name):
+            start = time.time()
+            result = match_dir(self, name)
+            counter = stats._counter(self)
+            counter.seconds += time.time() - start
+            counter.evaluations += 1
+            if result[0]:
+                counter.matches += 1
+            return result
+
+        cls.match_file = counted_match_file
+        cls.match_dir = counted_match_dir
+
+    def uninstall(self):
+        """Stop counting pattern matches."""
+        if self.saved is None:
+            return
+        cls = pattern.PathPattern
+        cls.match_file, cls.match_dir = self.saved
+        self.saved = None
+
+    def top(self, limit=0):
+        """Get the counters which took the most time."""
+        counters = sorted(self.counters.values(),
+                          key=lambda c: (-c.seconds, c.source))
+        if limit:
+            counters = counters[:limit]
+        return counters
+
+    def write(self, fp, limit=0):
+        """Write a table of the patterns which took the most time."""
+        fp.write('{:>10} {:>10} {:>10}  {}\n'.format(
+            'evals', 'matches', 'ms', 'pattern'))
+        for c in self.top(limit):
+            fp.write('{:>10} {:>10} {:>10.1f}  {}: {}\n'.format(
+                c.evaluations, c.matches, c.seconds * 1000,
+                c.source, c.text))
@@ -0,0 +1,168 @@
+# Copyright 2013 Dietrich Epp.
+#
+# This file is part of HeaderFix.  HeaderFix is distributed under the terms of
+# the 2-clause BSD license.  See LICENSE.txt for details.
+
+"""Limits for running alongside other jobs on a shared machine.
+
+A Throttle limits the files per second and the bytes per second which
+a session reads and writes.  Limits are averages: a large file is
+read at once, and the run then waits until the limit allows it.  The
+number of subprocesses which diff files can be limited for the whole
+process, and the process can be given idle CPU and I/O priority.
+"""
+import contextlib
+import os
+import platform
+import re
+import subprocess
+import sys
+import threading
+import time
+from . import util
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+_clock = getattr(time, 'monotonic', time.time)
+
+SIZE = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*([kKMG]?)B?\s*$')
+SIZE_UNITS = {'': 1, 'k': 1000, 'K': 1024, 'M': 1000 ** 2, 'G': 1000 ** 3}
+
+def parse_size(text):
+    """Parse a number of bytes, such as "500k" or "20M"."""
+    match = SIZE.match(text)
+    if not match:
+        raise ValueError('invalid size: {}'.format(text))
+    size = float(match.group(1)) * SIZE_UNITS[match.group(2)]
+    if size <= 0:
+        raise ValueError('size must be positive: {}'.format(text))
+    return size
+
+class TokenBucket(object):
+    """Limits the average rate of an activity.
+
+    Up to a second's worth of the rate can be used at once.  Using
+    more puts the bucket in debt, and the next use waits until the
+    debt is paid, so a large amount used at once is still limited.
+    """
+    __slots__ = ['rate', 'tokens', 'last']
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = _clock()
+
+    def take(self, amount):
+        """Use an amount, first waiting until the rate allows it."""
+        now = _clock()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+            self.tokens = 0.0
+            self.last = _clock()
+        self.tokens -= amount
+
+class Throttle(object):
+    """Limits on the files per second and the bytes per second.
+
+    Either limit may be None.
+    """
+    __slots__ = ['file_rate', 'io_rate', 'files', 'io']
+
+    def __init__(self, file_rate=None, io_rate=None):
+        self.file_rate = file_rate
+        self.io_rate = io_rate
+        self.files = TokenBucket(file_rate) if file_rate else None
+        self.io = TokenBucket(io_rate) if io_rate else None
+
+    def read(self, size):
+        """Count a file which was read."""
+        if self.files is not None:
+            self.files.take(1)
+        if self.io is not None:
+            self.io.take(size)
+
+    def write(self, size):
+        """Count a file which is written."""
+        if self.io is not None:
+            self.io.take(size)
+
+_subprocesses = None
+
+def set_max_subprocesses(count):
+    """Limit the number of diff subprocesses running at once.
+
+    A count of None or 0 removes the limit.
+    """
+    global _subprocesses
+    if count:
+        _subprocesses = threading.BoundedSemaphore(count)
+    else:
+        _subprocesses = None
+
+@contextlib.contextmanager
+def subprocess_slot():
+    """Wait until another subprocess may run."""
+    semaphore = _subprocesses
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+# Numbers of the ioprio_set system call on Linux.
+IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64': 273,
+    'ppc64le': 273,
+    's390x': 282,
+    'riscv64': 30,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def _set_idle_io():
+    if not sys.platform.startswith('linux'):
+        return False
+    number = IOPRIO_SET.get(platform.machine())
+    if ctypes is not None and number is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+                            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0:
+                return True
+        except (OSError, AttributeError):
+            pass
+    ionice = util.find_executable('ionice')
+    if ionice is None:
+        return False
+    try:
+        return subprocess.call(
+            [ionice, '-c', '3', '-p', str(os.getpid())]) == 0
+    except OSError:
+        return False
+
+def set_idle_priority():
+    """Give the process idle CPU and I/O priority.
+
+    This should be done before starting threads or subprocesses,
+    which inherit the priority.  Returns (cpu, io), which are true if
+    the CPU and I/O priority were set.
+    """
+    cpu = False
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(19 - os.nice(0))
+            cpu = True
+        except OSError:
+            pass
+    return cpu, _set_idle_io()
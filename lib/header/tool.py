@@ -3,40 +3,101 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+from __future__ import print_function
 import argparse
+import itertools
 import os
-import subprocess
 import sys
-from . import rule
-from . import scan
-from . import pattern
-from . import sourcefile
-from . import filetype
-from . import comment
+from . import api
 from . import diff
+from . import git
+from . import gitfilter
+from . import memory
 from . import util
-from . import copyright
 from . import year
+from . import shard
+from . import progress
+from . import report
+from . import server
+from . import stats
+from . import throttle
 try:
     import readline
 except ImportError:
     pass
 
 def error(msg):
-    print >>sys.stderr, 'error: {}'.format(msg)
+    print('error: {}'.format(msg), file=sys.stderr)
     sys.exit(1)
 
-def relpath_parts(path, base):
-    parts = []
-    curpath = path
-    while curpath != base:
-        lastpath = curpath
-        curpath, fname = os.path.split(curpath)
-        if lastpath == curpath:
-            error('path not contained in repository: {}'.format(path))
-        parts.append(fname)
-    parts.reverse()
-    return parts
+def merge_reports(paths, output):
+    """Merge JSON reports from different shards."""
+    reports = []
+    for path in paths:
+        try:
+            with open(path) as fp:
+                reports.append(report.Report.read(fp))
+        except (IOError, ValueError, KeyError) as ex:
+            error('{}: could not read report: {}'.format(path, ex))
+    try:
+        merged = report.Report.merge(reports)
+    except ValueError as ex:
+        error(ex)
+    for index, count in merged.missing_shards():
+        print('warning: missing shard {}/{}'.format(index + 1, count),
+              file=sys.stderr)
+    if output is None:
+        merged.write(sys.stdout)
+    else:
+        with open(output, 'w') as fp:
+            merged.write(fp)
+
+def estimate_files(session, root, args):
+    """Estimate the number of files a run checks, or return None.
+
+    The estimate is the number of files in the index, which the run
+    scans whether or not they are source files, and is only made when
+    the whole repository is checked.
+    """
+    toplevel = session.repository(root).root
+    if any(os.path.abspath(path) != toplevel for path in args.path):
+        return None
+    total = git.index_entry_count(toplevel)
+    if total is not None and args.shard is not None:
+        total //= args.shard[1]
+    return total
+
+def rewrite_history(args, options):
+    """Rewrite history from a git fast-export stream.
+
+    Every change is applied, unless --no-action is given, since
+    standard input and output carry the streams.
+    """
+    session = api.Session()
+    run_report = report.Report()
+    run_progress = None
+    if args.progress is not None:
+        run_progress = progress.PROGRESS[args.progress](sys.stderr)
+    results = session.rewrite_history(
+        util.binary(sys.stdin), util.binary(sys.stdout), options)
+    try:
+        for result in results:
+            changed = result.changed
+            if changed and not args.no_action:
+                result.save()
+            run_report.add_file(result.name, changed)
+            if run_progress is not None:
+                run_progress.update(
+                    result.name, len(result.original), changed)
+    except ValueError as ex:
+        error(ex)
+    finally:
+        results.close()
+        if run_progress is not None:
+            run_progress.finish()
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            run_report.write(fp)
 
 def run(args):
     parser = argparse.ArgumentParser()
@@ -83,77 +144,267 @@ def run(args):
         '--rights',
         dest='rights', action='append', default=[],
         help="set the body of the copyright message")
+    parser.add_argument(
+        '--cached',
+        dest='cached', action='store_true', default=False,
+        help='fix the contents staged in the index, not the work tree')
+    parser.add_argument(
+        '--shard',
+        type=shard.parse_shard, metavar='I/N',
+        help='only check shard I of N, numbered from 1')
+    parser.add_argument(
+        '--shard-by',
+        dest='shard_by', choices=sorted(shard.SHARD_METHODS),
+        default='hash',
+        help='split shards by path hash, or by file size in the index')
+    parser.add_argument(
+        '--report',
+        metavar='FILE',
+        help='write a JSON report of the results')
+    parser.add_argument(
+        '--merge-reports',
+        dest='merge_reports', nargs='+', metavar='REPORT',
+        help='merge JSON reports from different shards and exit')
+    parser.add_argument(
+        '--long-lines',
+        dest='long_lines', metavar='DEST', default='stdout',
+        help='report long lines to stdout, stderr, or a file')
+    parser.add_argument(
+        '--long-lines-format',
+        dest='long_lines_format', choices=sorted(report.LONG_LINE_SINKS),
+        default='text',
+        help='report long lines as text or as JSON lines')
+    parser.add_argument(
+        '--long-lines-limit',
+        dest='long_lines_limit', type=int, metavar='N', default=0,
+        help='only list the first N long lines in each file')
+    parser.add_argument(
+        '--cache-size',
+        dest='cache_size', type=int, metavar='N', default=256,
+        help='remember fixes for up to N distinct file contents '
+        '(0 to disable caching)')
+    parser.add_argument(
+        '--scan-threads',
+        dest='scan_threads', type=int, metavar='N', default=1,
+        help='list up to N directories at once, for network file systems')
+    parser.add_argument(
+        '--idle',
+        action='store_true', default=False,
+        help='run with idle CPU and I/O priority')
+    parser.add_argument(
+        '--file-rate',
+        dest='file_rate', type=float, metavar='N',
+        help='read at most N files per second')
+    parser.add_argument(
+        '--io-rate',
+        dest='io_rate', type=throttle.parse_size, metavar='BYTES',
+        help='read and write at most BYTES per second, such as 20M')
+    parser.add_argument(
+        '--max-subprocesses',
+        dest='max_subprocesses', type=int, metavar='N',
+        help='run at most N diff subprocesses at once')
+    parser.add_argument(
+        '--explain',
+        metavar='PATH',
+        help='show how the settings for a path are chosen and exit')
+    parser.add_argument(
+        '--pattern-stats',
+        dest='pattern_stats', type=int, metavar='N', nargs='?', const=20,
+        help='show the N patterns which took the most time')
+    parser.add_argument(
+        '--memory-stats',
+        dest='memory_stats', type=int, metavar='N', nargs='?', const=20,
+        help='show the memory used by each phase and the N files which '
+        'used the most, and add them to the report')
+    parser.add_argument(
+        '--progress',
+        nargs='?', const='text', choices=sorted(progress.PROGRESS),
+        help='report progress on stderr, as text or as JSON lines')
+    parser.add_argument(
+        '--archive',
+        metavar='IN.tar',
+        help='check the files in a tar archive instead of a repository')
+    parser.add_argument(
+        '--archive-out',
+        dest='archive_out', metavar='OUT.tar',
+        help='write the archive with the changes which were applied')
+    parser.add_argument(
+        '--fast-export',
+        dest='fast_export', action='store_true', default=False,
+        help='rewrite a git fast-export stream on standard input '
+        'as a git fast-import stream on standard output')
+    parser.add_argument(
+        '--filter-process',
+        dest='filter_process', action='store_true', default=False,
+        help='run as a Git filter process, fixing files as they are staged')
+    parser.add_argument(
+        '--server',
+        dest='server', action='store_true', default=False,
+        help='answer JSON-RPC requests on standard input')
     parser.add_argument(
         'path',
         nargs='*', default=['.'],
         help='scan the given paths')
-    args = parser.parse_args()
+    args = parser.parse_args(args)
+
+    if args.merge_reports:
+        merge_reports(args.merge_reports, args.report)
+        return
+
+    options = api.Options(
+        copyright_author=args.copyright_author,
+        copyright_years=args.copyright_years,
+        ignore=args.ignore,
+        whitespace=args.whitespace,
+        cached=args.cached,
+        shard=args.shard,
+        shard_by=args.shard_by,
+        cache_size=args.cache_size,
+        scan_threads=args.scan_threads,
+        file_rate=args.file_rate,
+        io_rate=args.io_rate)
+    if args.idle:
+        cpu, io = throttle.set_idle_priority()
+        failed = [name for name, ok in (('CPU', cpu), ('I/O', io)) if not ok]
+        if failed:
+            print('warning: could not set idle {} priority'
+                  .format(' and '.join(failed)), file=sys.stderr)
+    throttle.set_max_subprocesses(args.max_subprocesses)
+    if args.server:
+        server.Server(api.Session(), options).serve(sys.stdin, sys.stdout)
+        return
+
+    if args.filter_process:
+        session = api.Session()
+        try:
+            root = session.repository(os.getcwd()).root
+            gitfilter.FilterProcess(session, options, root).serve(
+                util.binary(sys.stdin), util.binary(sys.stdout))
+        except (ValueError, EOFError) as ex:
+            error(str(ex) or 'unexpected end of input')
+        return
+
+    if args.fast_export:
+        rewrite_history(args, options)
+        return
 
-    paths = [os.path.abspath(path) for path in args.path]
-    root = paths[0]
-    if not os.path.isdir(root):
-        root = os.path.dirname(root)
+    if args.explain is not None:
+        try:
+            lines = api.Session().explain(args.explain, options)
+        except ValueError as ex:
+            error(ex)
+        for line in lines:
+            print(line)
+        return
+
+    if args.pattern_stats is not None:
+        pattern_stats = stats.PatternStats()
+        pattern_stats.install()
+    else:
+        pattern_stats = None
+    if args.memory_stats is not None:
+        memory_stats = memory.MemoryStats(args.memory_stats)
+        memory_stats.install()
+    else:
+        memory_stats = None
+
+    session = api.Session(interactive=True)
+    if args.shard is not None:
+        run_report = report.Report([args.shard])
+    else:
+        run_report = report.Report()
+    if args.archive is not None:
+        if args.archive_out is None and not args.no_action:
+            error('--archive-out is required to apply changes to an archive')
+        root = None
+        results = session.process_archive(
+            args.archive, args.archive_out, options)
+    else:
+        root = os.path.abspath(args.path[0])
         if not os.path.isdir(root):
-            error('cannot find repository root: {}'.format(paths[0]))
-    root = subprocess.check_output(
-        ['git', 'rev-parse', '--show-toplevel'],
-        cwd=root)[:-1]
-    paths = [relpath_parts(path, root) for path in paths]
-    if all(paths):
-        includes = pattern.PatternSet(
-            (True, pattern.LiteralPattern(True, path)) for path in paths)
+            root = os.path.dirname(root)
+            if not os.path.isdir(root):
+                error('cannot find repository root: {}'
+                      .format(args.path[0]))
+        results = session.process(
+            root, [os.path.abspath(path) for path in args.path], options)
+
+    if args.long_lines == 'stdout':
+        long_lines_fp = sys.stdout
+    elif args.long_lines == 'stderr':
+        long_lines_fp = sys.stderr
     else:
-        includes = None
-
-    excludes = pattern.PatternSet.parse(['.*'] + args.ignore)
-
-    authorship = copyright.AutoAuthorship(
-        root, args.copyright_author, args.copyright_years)
-    rules = rule.Rules({'_authorship': authorship}, [])
-    rules = rules.union(rule.Rules.read_global_gitignore())
-    long_lines = []
-    for path, env in scan.scan_dir(rules, root, includes, excludes):
-        relpath = os.path.relpath(path)
-        ftype = filetype.get_filetype(path)
-        if ftype.name == 'unknown':
-            continue
-        src = sourcefile.SourceFile(path, relpath, env, ftype)
-
-        src.run_filters()
-        if args.whitespace:
-            src.expand_tabs()
-            src.fix_whitespace()
-        flong_lines = list(src.long_lines())
-        if flong_lines:
-            long_lines.append((relpath, flong_lines))
-
-        d = src.diff()
-        if d is not None:
-            if args.no_action:
-                print
-                print
-                diff.show_diff(d)
-            elif args.yes:
-                print('Updating {}'.format(relpath))
-                src.save()
+        long_lines_fp = open(args.long_lines, 'w')
+    long_lines = report.LONG_LINE_SINKS[args.long_lines_format](
+        long_lines_fp, args.long_lines_limit)
+    run_progress = None
+    try:
+        if args.progress is not None:
+            if root is not None:
+                total = estimate_files(session, root, args)
+                scanned = lambda: session.scanned
             else:
-                print
-                print
-                diff.show_diff(d)
-                choice = util.ask(
-                    'Apply changes to {} [y,n,q]?'.format(relpath),
-                    None, ('Y', 'N', 'Q'))
-                if choice == 'Q':
-                    return
-                if choice == 'Y':
-                    src.save()
-
-    if long_lines:
-        for relpath, flong_lines in long_lines:
-            print
-            print '{}: Lines too long'.format(relpath)
-            for lineno, width in flong_lines:
-                print '    {}: {} columns'.format(lineno, width)
+                total = None
+                scanned = None
+            run_progress = progress.PROGRESS[args.progress](
+                sys.stderr, total, scanned=scanned)
+        for result in results:
+            relpath = result.relpath
+
+            changed = result.changed
+            file_long_lines = result.long_lines()
+            if run_progress is not None:
+                first = next(file_long_lines, None)
+                if first is not None:
+                    file_long_lines = itertools.chain(
+                        [first], file_long_lines)
+                if changed or first is not None:
+                    run_progress.clear()
+            if changed:
+                if args.no_action:
+                    print()
+                    print()
+                    diff.show_diff(result.diff())
+                elif args.yes:
+                    print('Updating {}'.format(relpath))
+                    result.save()
+                else:
+                    print()
+                    print()
+                    diff.show_diff(result.diff())
+                    choice = util.ask(
+                        'Apply changes to {} [y,n,q]?'.format(relpath),
+                        None, ('Y', 'N', 'Q'))
+                    if choice == 'Q':
+                        return
+                    if choice == 'Y':
+                        result.save()
+
+            run_report.add_file(
+                result.name, changed,
+                long_lines.add(relpath, file_long_lines))
+            if run_progress is not None:
+                run_progress.update(
+                    result.name, len(result.original), changed)
+    except ValueError as ex:
+        error(ex)
+    finally:
+        results.close()
+        if run_progress is not None:
+            run_progress.finish()
+        if long_lines_fp not in (sys.stdout, sys.stderr):
+            long_lines_fp.close()
+        if pattern_stats is not None:
+            pattern_stats.uninstall()
+            pattern_stats.write(sys.stderr, args.pattern_stats)
+        if memory_stats is not None:
+            memory_stats.uninstall()
+            run_report.memory = memory_stats.to_json()
+            memory_stats.write(sys.stderr)
+
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            run_report.write(fp)
 
 if __name__ == '__main__':
     import sys
@@ -3,9 +3,72 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+from __future__ import print_function
+import io
 import os
+import sys
 from . import colors
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
+# Configuration, paths, and messages are text, and file contents are
+# bytes.  On Python 3, they are converted as UTF-8, and bytes which
+# are not UTF-8 are kept as surrogate escapes, so every file round
+# trips unchanged.  On Python 2, text is bytes, so these do nothing.
+if bytes is str:
+    def encode(text):
+        """Convert text to bytes."""
+        return text
+
+    def decode(data):
+        """Convert bytes to text."""
+        return data
+
+    def open_text(path):
+        """Open a text file for reading."""
+        return open(path)
+
+    def text_file(data, name):
+        """Get a text file object for reading the given bytes."""
+        fp = io.BytesIO(data)
+        fp.name = name
+        return fp
+
+    def binary(fp):
+        """Get the binary stream for a standard stream."""
+        return fp
+else:
+    def encode(text):
+        """Convert text to bytes."""
+        if isinstance(text, bytes):
+            return text
+        return text.encode('UTF-8', 'surrogateescape')
+
+    def decode(data):
+        """Convert bytes to text."""
+        if isinstance(data, str):
+            return data
+        return data.decode('UTF-8', 'surrogateescape')
+
+    def open_text(path):
+        """Open a text file for reading."""
+        return open(path, encoding='UTF-8', errors='surrogateescape')
+
+    def text_file(data, name):
+        """Get a text file object for reading the given bytes."""
+        fp = io.BytesIO(data)
+        fp.name = name
+        return io.TextIOWrapper(fp, encoding='UTF-8',
+                                errors='surrogateescape')
+
+    def binary(fp):
+        """Get the binary stream for a standard stream."""
+        fp.flush()
+        return fp.buffer
+
 def find_executable(name):
     """Find the path to an executable, or return None if not found."""
     for path in os.environ['PATH'].split(os.path.pathsep):
@@ -20,12 +83,12 @@ def ask(what, default=None, choices=()):
     prompt = '{0.bold.blue}{1}{0.reset} '.format(colors.colors(), what)
     while True:
         try:
-            answer = raw_input(prompt)
+            answer = input(prompt)
         except KeyboardInterrupt:
-            print
+            print()
             raise
         except EOFError:
-            print
+            print()
             sys.exit(1)
         answer = answer.strip()
         if answer:
@@ -3,17 +3,143 @@
 # This file is part of HeaderFix.  HeaderFix is distributed under the terms of
 # the 2-clause BSD license.  See LICENSE.txt for details.
 
+import functools
 import re
 
 YEAR = re.compile(r'\d+')
 
+@functools.total_ordering
+class YearRanges(object):
+    """An immutable set of years, stored as a list of intervals.
+
+    The intervals are (first, last) pairs, inclusive, in increasing
+    order, which neither overlap nor touch.  Iterating over the set
+    yields each year in order.  Sets compare in the same order as the
+    sorted lists of years they contain.
+    """
+    __slots__ = ['ranges']
+
+    def __init__(self, ranges=()):
+        merged = []
+        for first, last in sorted(ranges):
+            if first > last:
+                raise ValueError('year range goes backwards')
+            if merged and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = merged[-1][0], last
+            else:
+                merged.append((first, last))
+        self.ranges = tuple(merged)
+
+    @classmethod
+    def _make(class_, ranges):
+        obj = class_.__new__(class_)
+        obj.ranges = tuple(ranges)
+        return obj
+
+    @classmethod
+    def from_years(class_, years):
+        """Get the set of years from any iterable of years."""
+        if isinstance(years, class_):
+            return years
+        return class_((year, year) for year in years)
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            for year in range(first, last + 1):
+                yield year
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    __bool__ = __nonzero__
+
+    def __contains__(self, year):
+        for first, last in self.ranges:
+            if year <= last:
+                return year >= first
+        return False
+
+    def __eq__(self, other):
+        if not isinstance(other, YearRanges):
+            return NotImplemented
+        return self.ranges == other.ranges
+
+    def __ne__(self, other):
+        if not isinstance(other, YearRanges):
+            return NotImplemented
+        return self.ranges != other.ranges
+
+    def __lt__(self, other):
+        if not isinstance(other, YearRanges):
+            return NotImplemented
+        a = self.ranges
+        b = other.ranges
+        for n in range(min(len(a), len(b))):
+            (afirst, alast), (bfirst, blast) = a[n], b[n]
+            if afirst != bfirst:
+                return afirst < bfirst
+            if alast < blast:
+                # Either a stops, or a continues with a later year.
+                return n + 1 == len(a)
+            if alast > blast:
+                return n + 1 < len(b)
+        return len(a) < len(b)
+
+    def __hash__(self):
+        return hash(self.ranges)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __repr__(self):
+        return 'YearRanges({!r})'.format(list(self.ranges))
+
+    def __str__(self):
+        return format_years(self)
+
+    def union(self, other):
+        """Compute the union of two sets of years."""
+        other = YearRanges.from_years(other)
+        if not other.ranges:
+            return self
+        if not self.ranges:
+            return other
+        a = self.ranges
+        b = other.ranges
+        i = 0
+        j = 0
+        merged = []
+        while i < len(a) or j < len(b):
+            if j >= len(b) or (i < len(a) and a[i] < b[j]):
+                first, last = a[i]
+                i += 1
+            else:
+                first, last = b[j]
+                j += 1
+            if merged and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = merged[-1][0], last
+            else:
+                merged.append((first, last))
+        return YearRanges._make(merged)
+
+    def intern(self):
+        """Get a shared object equal to this set of years."""
+        return _INTERNED.setdefault(self, self)
+
+_INTERNED = {}
+
 def parse_years(years):
     """Parse a range of years as a set.
 
     For example, this will parse "1999-2001, 2007" as the set {1999,
-    2000, 2001, 2007}.
+    2000, 2001, 2007}.  Returns a YearRanges object.
     """
-    yearset = set()
+    ranges = []
     lastyear = None
     lastpos = 0
     for match in YEAR.finditer(years):
@@ -31,40 +157,25 @@ def parse_years(years):
             if lastyear is None or ',' in delim:
                 raise ValueError('cannot parse year range: {}'.format(years))
             if year > lastyear:
-                yearset.update(range(lastyear + 1, year + 1))
+                ranges[-1] = lastyear, year
             else:
                 raise ValueError(
                     'year range goes backwards: {}'.format(years))
             lastyear = None
         else:
-            yearset.add(year)
+            ranges.append((year, year))
             lastyear = year
-    return yearset
+    return YearRanges(ranges)
 
 def format_years(yearset):
     """Format a set of years.
 
     For example, this will format the set {1999, 2000, 2001, 2007} as
-    "1999-2001, 2007".
+    "1999-2001, 2007".  The set can be a YearRanges object or any
+    iterable of years.
     """
-    yearlist = list(yearset)
-    yearlist.sort()
-    firstyear = None
-    ranges = []
-    for year in yearlist:
-        if firstyear is None:
-            firstyear = year
-            lastyear = year
-        elif year == lastyear + 1:
-            lastyear = year
-        else:
-            ranges.append((firstyear, lastyear))
-            firstyear = year
-            lastyear = year
-    if firstyear is not None:
-        ranges.append((firstyear, lastyear))
     tranges = []
-    for firstyear, lastyear in ranges:
+    for firstyear, lastyear in YearRanges.from_years(yearset).ranges:
         if firstyear < lastyear:
             tranges.append('{}-{}'.format(firstyear, lastyear))
         else:
@@ -86,3 +197,26 @@ if __name__ == '__main__':
     test('2000, 1, 2', '2000-2002')
     test('2000-10', '2000-2010')
     test('1999, 2000, 2001, 2008-2009', '1999-2001, 2008-2009')
+    test('2005, 2001-2003, 2004', '2001-2005')
+
+    def test_union(a, b, o):
+        x = format_years(parse_years(a) | parse_years(b))
+        if x != o:
+            sys.stderr.write(
+                'error: expected {!r}, got {!r}\n'.format(o, x))
+            sys.exit(1)
+    test_union('2001-2003', '2005', '2001-2003, 2005')
+    test_union('2001-2003', '2004, 2010', '2001-2004, 2010')
+    test_union('2000, 2010', '2001-2009', '2000-2010')
+
+    def test_order(a, b):
+        ya = parse_years(a)
+        yb = parse_years(b)
+        if (ya < yb) != (list(ya) < list(yb)):
+            sys.stderr.write(
+                'error: wrong order for {!r} and {!r}\n'.format(a, b))
+            sys.exit(1)
+    for a in ('2000', '2000-2002', '2000, 2005', '2000-2001, 2003'):
+        for b in ('2000', '2000-2002', '2000, 2005', '2001'):
+            test_order(a, b)
+            test_order(b, a)